@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the bot's hot paths, run against a throwaway database:
+
+    python bench.py indexes [--rows 2000000]
+    python bench.py exports [--rows 1000000]
+    python bench.py parser [--messages 200000]
+    python bench.py reports [--rows 1000000]
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# main.py reads DB_PATH at import time, so point it at a scratch file first.
+# Child processes spawned by a benchmark reuse their parent's database via BENCH_DB.
+_TMP_DIR = tempfile.mkdtemp(prefix="sum-bench-")
+os.environ["DB_PATH"] = os.environ.get("BENCH_DB") or os.path.join(_TMP_DIR, "bench.db")
+
+import main  # noqa: E402
+
+CHATS = [-1000000000000 - i for i in range(40)]
+
+
+def _timed(fn, repeat: int = 3) -> float:
+    """Best of `repeat` runs, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def populate_history(rows: int, seed: int = 7):
+    """Fill history (and old_totals) with `rows` receipts spread over ~3 years and 40 chats."""
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1, 6, 0, 0)
+    step = timedelta(days=3 * 365) / rows
+
+    def gen():
+        for i in range(rows):
+            dt = start + step * i
+            shift, biz = main.get_shift_and_business_date(dt)
+            currency = "USD" if rng.random() < 0.7 else "KHR"
+            # Minor units: cents / riel
+            amount = rng.randrange(50, 6000) if currency == "USD" else rng.randrange(1000, 200000, 500)
+            yield (rng.choice(CHATS), dt.strftime("%Y-%m-%d %H:%M:%S"), biz, shift, currency, amount)
+
+    with main.DB.write() as conn:
+        conn.executemany(
+            """INSERT INTO history (chat_id, datetime, business_date, shift, currency, amount)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            gen(),
+        )
+        conn.execute(
+            """INSERT INTO old_totals (chat_id, date, shift, currency, total, invoices)
+               SELECT chat_id, business_date, shift, currency, SUM(amount), COUNT(*)
+               FROM history GROUP BY chat_id, business_date, shift, currency"""
+        )
+
+
+def bench_indexes(args):
+    print(f"Building history with {args.rows:,} rows in {_TMP_DIR} ...")
+    main.init_db()
+    # Start from the pre-index schema: drop what init_db just created
+    with main.DB.write() as conn:
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall():
+            conn.execute(f"DROP INDEX {name}")
+    t0 = time.perf_counter()
+    populate_history(args.rows)
+    print(f"  populated in {time.perf_counter() - t0:.1f}s")
+
+    chat = CHATS[3]
+    queries = {
+        "recalc GROUP BY": (
+            """SELECT chat_id, business_date, shift, currency, SUM(amount), COUNT(*)
+               FROM history GROUP BY chat_id, business_date, shift, currency""",
+            (),
+        ),
+        "/dump last 50": (
+            "SELECT id, chat_id, datetime, business_date, shift, currency, amount FROM history ORDER BY datetime DESC LIMIT 50",
+            (),
+        ),
+        "chat month range": (
+            """SELECT id, chat_id, datetime, business_date, shift, currency, amount FROM history
+               WHERE chat_id = ? AND business_date BETWEEN ? AND ? ORDER BY datetime""",
+            (chat, "2025-06-01", "2025-06-30"),
+        ),
+        "old_totals day": (
+            """SELECT currency, SUM(total), SUM(invoices) FROM old_totals
+               WHERE chat_id = ? AND date = ? GROUP BY currency""",
+            (chat, "2025-06-15"),
+        ),
+    }
+
+    def run_all():
+        results = {}
+        with main.DB.read() as conn:
+            for name, (sql, params) in queries.items():
+                results[name] = _timed(lambda: conn.execute(sql, params).fetchall())
+        return results
+
+    before = run_all()
+    t0 = time.perf_counter()
+    main.init_db()  # creates the indexes on the populated tables, as a migration would
+    print(f"  indexes built in {time.perf_counter() - t0:.1f}s")
+    main.DB.close()  # readers re-open and pick up the new schema and stats
+    after = run_all()
+
+    print(f"\n{'query':<20}{'no index (ms)':>16}{'indexed (ms)':>16}{'speedup':>10}")
+    for name in queries:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        print(f"{name:<20}{before[name]:>16.2f}{after[name]:>16.2f}{speedup:>9.1f}x")
+
+
+def bench_exports(args):
+    print(f"Building history with {args.rows:,} rows in {_TMP_DIR} ...")
+    main.init_db()
+    populate_history(args.rows)
+    main.DB.close()
+
+    env = dict(os.environ, BENCH_DB=os.environ["DB_PATH"])
+    print(f"\n{'format':<10}{'wall (s)':>10}{'peak RSS (MB)':>16}{'size (MB)':>12}")
+    for fmt in main.EXPORT_FORMATS:
+        # One process per format so ru_maxrss is that export's own peak
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "_export", fmt],
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        out = proc.stdout.read()
+        _pid, status, usage = os.wait4(proc.pid, 0)
+        if status != 0:
+            print(f"{fmt:<10}failed (exit status {status})")
+            continue
+        wall, size = (float(v) for v in out.split()[-2:])
+        print(f"{fmt:<10}{wall:>10.2f}{usage.ru_maxrss / 1024:>16.1f}{size / 1e6:>12.1f}")
+
+
+def _export_child(args):
+    # Runs inside the child process started by bench_exports
+    start = time.perf_counter()
+    path = main.export_history(main.ExportFilters(), args.fmt)
+    wall = time.perf_counter() - start
+    size = os.path.getsize(path)
+    os.remove(path)
+    print(wall, size)
+
+
+# Shapes of what the group chats see: mostly chatter, some receipts and totals
+CHATTER = [
+    "សួស្តី",
+    "ok bong",
+    "អរគុណច្រើន 🙏",
+    "Customer asks for delivery at 3pm, table 12",
+    "តើថ្ងៃនេះបើកម៉ោងប៉ុន្មាន?",
+    "👍",
+    "Please check the order for room 204 again",
+    "📊 Total",
+    "ចាំបន្តិច",
+    "call me when you arrive at the shop, 2 boxes left",
+]
+RECEIPTS = [
+    "{usd:.2f}$",
+    "${usd:.2f}",
+    "{khr:,}៛",
+    "៛{khr}",
+    "{usd:.2f} USD",
+    "{khr} khr",
+    "✅ Paid {usd:.2f}$ + {khr:,}៛ (invoice #{n})",
+    "Invoice {n}: total {usd:.2f} usd, cash",
+    "{khr_kh}៛",
+    "{k}k riel",
+    "{d} dollars",
+    "{usd_comma}$",
+    "{k}ពាន់រៀល",
+]
+KHMER_DIGITS = str.maketrans("0123456789", "០១២៣៤៥៦៧៨៩")
+
+# Message -> what the parser must return
+EXPECTED = {
+    "10,000៛": [(10000.0, "KHR")],
+    "1,234.50 usd": [(1234.5, "USD")],
+    "$5, $10": [(5.0, "USD"), (10.0, "USD")],
+    "$5 $10": [(5.0, "USD"), (10.0, "USD")],
+    "$5 ៛1000": [(5.0, "USD"), (1000.0, "KHR")],
+    "១៥០០០៛": [(15000.0, "KHR")],
+    "20k riel": [(20000.0, "KHR")],
+    "1.5m៛": [(1500000.0, "KHR")],
+    "5 dollars": [(5.0, "USD")],
+    "12,50$": [(12.5, "USD")],
+    "២ម៉ឺនរៀល": [(20000.0, "KHR")],
+    "បានទទួលដុល្លារ 3": [],
+    "5km usd": [],
+    "1,0000$": [(10000.0, "USD")],
+    "1,2345$": [(12345.0, "USD")],
+    "10.000,50$": [(10000.5, "USD")],
+    "1.000.000៛": [(1000000.0, "KHR")],
+    "room 204": [],
+}
+
+
+def message_corpus(count: int, receipt_share: float = 0.15, seed: int = 11) -> list[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for n in range(count):
+        if rng.random() < receipt_share:
+            usd, khr = rng.uniform(0.5, 500), rng.randrange(500, 2_000_000, 500)
+            corpus.append(
+                rng.choice(RECEIPTS).format(
+                    usd=usd,
+                    khr=khr,
+                    n=n,
+                    khr_kh=str(khr).translate(KHMER_DIGITS),
+                    k=rng.randrange(1, 500),
+                    d=rng.randrange(1, 100),
+                    usd_comma=f"{usd:.2f}".replace(".", ","),
+                )
+            )
+        else:
+            corpus.append(rng.choice(CHATTER))
+    return corpus
+
+
+def legacy_extract_currency_amounts(text: str):
+    # The parser as it was before the precompiled pattern, kept for comparison
+    text = text.replace(",", "")
+    pattern = r"""
+        (?:
+            (?P<symbol_before>[$៛])\s*(?P<amount1>[-+]?\d*\.?\d+)
+            |
+            (?P<amount2>[-+]?\d*\.?\d+)\s*(?P<code_after>USD|KHR)
+            |
+            (?P<amount3>[-+]?\d*\.?\d+)\s*(?P<symbol_after>[$៛])
+        )
+    """
+    results = []
+    for m in re.finditer(pattern, text, re.IGNORECASE | re.VERBOSE):
+        if m.group("symbol_before") and m.group("amount1"):
+            results.append((float(m.group("amount1")), "USD" if m.group("symbol_before") == "$" else "KHR"))
+        elif m.group("amount2") and m.group("code_after"):
+            results.append((float(m.group("amount2")), m.group("code_after").upper()))
+        elif m.group("amount3") and m.group("symbol_after"):
+            results.append((float(m.group("amount3")), "USD" if m.group("symbol_after") == "$" else "KHR"))
+    return results
+
+
+def bench_parser(args):
+    corpus = message_corpus(args.messages)
+    parsers = {"legacy": legacy_extract_currency_amounts, "current": main.extract_currency_amounts}
+
+    wrong = {text: got for text, want in EXPECTED.items() if (got := main.extract_currency_amounts(text)) != want}
+    print(f"grammar samples: {len(EXPECTED) - len(wrong)}/{len(EXPECTED)} parsed as expected")
+    for text, got in wrong.items():
+        print(f"  {text!r}: got {got}, expected {EXPECTED[text]}")
+
+    missed = sum(1 for text in corpus if len(parsers["legacy"](text)) < len(parsers["current"](text)))
+    print(f"{len(corpus):,} messages, {missed:,} with amounts only the current parser finds")
+
+    print(f"\n{'parser':<10}{'messages/s':>14}{'µs/message':>14}")
+    for name, parse in parsers.items():
+        ms = _timed(lambda: [parse(text) for text in corpus])
+        print(f"{name:<10}{len(corpus) / ms * 1000:>14,.0f}{ms * 1000 / len(corpus):>14.2f}")
+
+    # Tokenizing is linear: a 10x longer message takes ~10x as long
+    for size in (10_000, 100_000):
+        text = "1,0000 " * (size // 7) + "5$"
+        print(f"{size:,}-char message: {_timed(lambda: main.extract_currency_amounts(text)):.1f} ms")
+
+
+def bench_reports(args):
+    print(f"Building history with {args.rows:,} rows in {_TMP_DIR} ...")
+    main.init_db()
+    populate_history(args.rows)
+    main.recalc_totals_from_history()  # also builds the rollup tables
+
+    chat = CHATS[3]
+    scopes = {
+        "chat, one year": main.ExportFilters(chat, "2024-03-15", "2025-03-14"),
+        "all chats, all dates": main.ExportFilters(),
+    }
+    print(f"\n{'summary':<32}{'history (ms)':>14}{'rollups (ms)':>14}{'speedup':>10}")
+    with main.DB.read() as conn:
+        for scope, filters in scopes.items():
+            where, params = filters.where()
+            for period, (_unit, period_sql) in main.REPORT_PERIODS.items():
+                spec = main.ReportSpec(filters, period)
+                scan = f"""SELECT {period_sql} AS period, currency, SUM(amount), COUNT(*) FROM history
+                           WHERE {where} GROUP BY period, currency ORDER BY period"""
+                before = _timed(lambda: conn.execute(scan, params).fetchall())
+                after = _timed(lambda: main._report_summary(conn, spec))
+                print(f"{period + ', ' + scope:<32}{before:>14.2f}{after:>14.2f}{before / after:>9.1f}x")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("indexes", help="history/old_totals query times with and without indexes")
+    p.add_argument("--rows", type=int, default=2_000_000)
+    p.set_defaults(func=bench_indexes)
+
+    p = sub.add_parser("exports", help="wall time and peak RSS of each export format over all of history")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.set_defaults(func=bench_exports)
+
+    p = sub.add_parser("parser", help="throughput of extract_currency_amounts over a synthetic chat corpus")
+    p.add_argument("--messages", type=int, default=200_000)
+    p.set_defaults(func=bench_parser)
+
+    p = sub.add_parser("reports", help="report summaries from history vs from the rollup tables")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.set_defaults(func=bench_reports)
+
+    p = sub.add_parser("_export")
+    p.add_argument("fmt")
+    p.set_defaults(func=_export_child)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    finally:
+        main.DB.close()
+        shutil.rmtree(_TMP_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
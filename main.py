@@ -3,9 +3,29 @@ import os
 import re
 import sqlite3
 import asyncio
+import bisect
 import io
-import pandas as pd
-from datetime import datetime, date, time, timedelta
+import csv
+import gzip
+import atexit
+import dataclasses
+import functools
+import hashlib
+import json
+import math
+import multiprocessing
+import queue
+import threading
+import pathlib
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
+from decimal import ROUND_HALF_UP, Decimal
+from openpyxl import Workbook
 from telegram.ext import Updater
 from telegram.ext import ApplicationBuilder
 
@@ -18,359 +38,2246 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
+from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
 
 # ==============================
 # ---------- Configuration -----
 # ==============================
-DB_PATH = "totals.db"
-OUTPUT_FILE = "totals_export.xlsx"
+DB_PATH = os.getenv("DB_PATH", "totals.db")
 
 # ⚠️ For safety, prefer BOT_TOKEN from environment if present.
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8103291457:AAFhfsVKjY05_0-cLFYxTAB71C3i_nsATZg")
 
-# Admins who can use /dump and /recalc
+# Admins who can use /dump, /recalc, /rezone, /rate, /shifts and /stats
 ADMINS = {2122623994}  # set of ints
 
-# Phnom Penh timezone is +07:00; if your server is already in local time, no tz conversion needed.
-# If you deploy on a UTC server, consider adding pytz/zoneinfo and converting to Asia/Phnom_Penh.
+# Shifts, business dates and history timestamps are in this zone, whatever the server's clock is set to.
+BOT_TIMEZONE = ZoneInfo(os.getenv("BOT_TIMEZONE", "Asia/Phnom_Penh"))
+
+
+def local_now() -> datetime:
+    return datetime.now(BOT_TIMEZONE)
 
 
 # ==============================
 # ---------- Database ----------
 # ==============================
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS totals (
-            chat_id INTEGER,
-            date TEXT,
-            shift TEXT,
-            currency TEXT,
-            total REAL,
-            invoices INTEGER,
-            PRIMARY KEY (chat_id, date, shift, currency)
-        )
+# Read-only connections kept open alongside the single writer.
+READ_POOL_SIZE = int(os.getenv("READ_POOL_SIZE", "4"))
+
+# Applied once to every pooled connection when it is opened.
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",  # safe with WAL: only a power loss can drop the last commits
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",  # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+class ConnectionPool:
+    """
+    Long-lived SQLite connections shared by every data function:
+    one writer (serialized by a lock, WAL mode) plus a small pool of read-only readers.
+    Connections are opened lazily and reused until close().
     """
+
+    def __init__(self, path: str, readers: int = READ_POOL_SIZE):
+        self.path = path
+        self._writer: sqlite3.Connection | None = None
+        self._write_lock = threading.Lock()
+        # None slots are opened on first checkout, so at most `readers` connections exist.
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        for _ in range(max(1, readers)):
+            self._readers.put(None)
+
+    def _configure(self, conn: sqlite3.Connection) -> sqlite3.Connection:
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _writer_conn(self) -> sqlite3.Connection:
+        if self._writer is None:
+            # isolation_level=None: transactions are managed explicitly in write()
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            self._writer = self._configure(conn)
+        return self._writer
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+        return self._configure(conn)
+
+    @contextmanager
+    def write(self):
+        """Yield the writer connection inside one IMMEDIATE transaction (commit on success)."""
+        with self._write_lock:
+            conn = self._writer_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    @contextmanager
+    def read(self):
+        """Check out a read-only connection; blocks while all readers are busy."""
+        conn = self._readers.get()
+        try:
+            if conn is None:
+                conn = self._reader_conn()
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def serialized(self):
+        """Yield the writer connection under the write lock, outside any transaction (reads ordered with writes)."""
+        with self._write_lock:
+            yield self._writer_conn()
+
+    def checkpoint(self):
+        """Copy the WAL back into the main database file and truncate it."""
+        with self._write_lock:
+            self._writer_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        conns = []
+        while True:
+            try:
+                conns.append(self._readers.get_nowait())
+            except queue.Empty:
+                break
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+            self._readers.put(None)
+
+
+DB = ConnectionPool(DB_PATH)
+
+# Created (or added to an existing DB) by init_db.
+INDEXES = (
+    # Covers recalc's GROUP BY and chat/business-date filters without touching the table
+    "CREATE INDEX IF NOT EXISTS idx_history_chat_day ON history (chat_id, business_date, shift, currency, amount)",
+    # /dump's ORDER BY datetime DESC LIMIT 50 and the chronological export
+    "CREATE INDEX IF NOT EXISTS idx_history_datetime ON history (datetime)",
+    # Date-range exports across all chats (admin only)
+    "CREATE INDEX IF NOT EXISTS idx_history_business_date ON history (business_date)",
+)
+
+
+# Amounts are stored as integers in each currency's minor unit (USD cents, riel), so sums are exact.
+MINOR_UNITS = {"USD": 100, "KHR": 1}
+# history.amount in currency units, for output that isn't formatted with format_amount.
+# Always REAL, so typed writers (Parquet) see one column type whatever the currency.
+AMOUNT_SQL = (
+    "CASE currency "
+    + " ".join(f"WHEN '{currency}' THEN amount / {unit}.0" for currency, unit in MINOR_UNITS.items() if unit != 1)
+    + " ELSE amount * 1.0 END"
+)
+# PRAGMA user_version once init_db's migrations have run:
+# 1 = amounts in minor units, 2 = one old_totals row per (chat_id, date, shift, currency),
+# 3 = rollup tables built from history
+SCHEMA_VERSION = 3
+
+# Used for totals, old_totals and recalc's shadow table, so all of them have the same shape.
+TOTALS_DDL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        chat_id INTEGER,
+        date TEXT,
+        shift TEXT,
+        currency TEXT,
+        total INTEGER,
+        invoices INTEGER,
+        PRIMARY KEY (chat_id, date, shift, currency)
     )
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS old_totals (
-            chat_id INTEGER,
-            date TEXT,
-            shift TEXT,
-            currency TEXT,
-            total REAL,
-            invoices INTEGER
+"""
+HISTORY_DDL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        datetime TEXT,
+        business_date TEXT,    -- 👈 added to keep "Shift 3" after midnight on the prior day
+        shift TEXT,
+        currency TEXT,
+        amount INTEGER
+    )
+"""
+
+
+def to_minor(amount: float, currency: str) -> int:
+    """Parsed amount -> integer minor units, rounded half up (5.005$ -> 501)."""
+    return int((Decimal(str(amount)) * MINOR_UNITS[currency]).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def format_amount(currency: str, minor: int) -> str:
+    """Exact display of a minor-unit amount: (USD, 123456) -> "1,234.56$", (KHR, 15000) -> "15,000៛"."""
+    if currency == "USD":
+        dollars, cents = divmod(abs(minor), 100)
+        return f"{'-' if minor < 0 else ''}{dollars:,}.{cents:02d}$"
+    return f"{minor:,}៛"
+
+
+def _migrate_to_minor_units(cursor: sqlite3.Cursor):
+    """
+    Rebuild history, totals and old_totals with INTEGER amounts converted from REAL currency units.
+    history ids are kept, so the recalc mark and export caches stay aligned.
+    """
+    to_minor_sql = "CAST(ROUND({col} * CASE upper(currency) " + " ".join(
+        f"WHEN '{currency}' THEN {unit}" for currency, unit in MINOR_UNITS.items()
+    ) + " ELSE 1 END) AS INTEGER)"
+    tables = {
+        "history": (HISTORY_DDL, "id, chat_id, datetime, business_date, shift, currency", "amount"),
+        "totals": (TOTALS_DDL, "chat_id, date, shift, currency, invoices", "total"),
+        "old_totals": (TOTALS_DDL, "chat_id, date, shift, currency, invoices", "total"),
+    }
+    for table, (ddl, columns, amount) in tables.items():
+        cursor.execute(f"DROP TABLE IF EXISTS {table}_minor")
+        cursor.execute(ddl.format(name=f"{table}_minor"))
+        cursor.execute(
+            f"""INSERT INTO {table}_minor ({columns}, {amount})
+                SELECT {columns}, {to_minor_sql.format(col=amount)} FROM {table}"""
         )
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_minor RENAME TO {table}")
+
+
+def _merge_old_totals(cursor: sqlite3.Cursor):
     """
-    )
+    Rebuild old_totals with its unique key, summing rows that repeated rollovers duplicated.
+    A restart used to restore moved totals from history, so pressing "🆕 New Data" again moved
+    the same receipts twice: a key never keeps more than its history holds.
+    """
+    cursor.execute("DROP TABLE IF EXISTS old_totals_merged")
+    cursor.execute(TOTALS_DDL.format(name="old_totals_merged"))
     cursor.execute(
+        """INSERT INTO old_totals_merged (chat_id, date, shift, currency, total, invoices)
+           SELECT o.chat_id, o.date, o.shift, o.currency,
+                  CASE WHEN o.invoices > h.invoices THEN h.total ELSE o.total END,
+                  CASE WHEN o.invoices > h.invoices THEN h.invoices ELSE o.invoices END
+           FROM (SELECT chat_id, date, shift, currency, SUM(total) AS total, SUM(invoices) AS invoices
+                 FROM old_totals GROUP BY chat_id, date, shift, currency) AS o
+           LEFT JOIN (SELECT chat_id, business_date, shift, currency, COALESCE(SUM(amount), 0) AS total, COUNT(*) AS invoices
+                      FROM history GROUP BY chat_id, business_date, shift, currency) AS h
+             ON h.chat_id = o.chat_id AND h.business_date = o.date AND h.shift = o.shift AND h.currency = o.currency"""
+    )
+    cursor.execute("DROP TABLE old_totals")
+    cursor.execute("ALTER TABLE old_totals_merged RENAME TO old_totals")
+
+
+def init_db():
+    with DB.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute(TOTALS_DDL.format(name="totals"))
+        cursor.execute(TOTALS_DDL.format(name="old_totals"))
+        cursor.execute(HISTORY_DDL.format(name="history"))
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            )
         """
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            datetime TEXT,
-            business_date TEXT,    -- 👈 added to keep "Shift 3" after midnight on the prior day
-            shift TEXT,
-            currency TEXT,
-            amount REAL
         )
-    """
-    )
 
-    # Add business_date if older DB didn’t have it
-    try:
-        cursor.execute("SELECT business_date FROM history LIMIT 1")
-    except sqlite3.OperationalError:
-        cursor.execute("ALTER TABLE history ADD COLUMN business_date TEXT")
+        # KHR per USD from a business date on; a date without its own row uses the latest earlier one
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS exchange_rates (
+                date TEXT PRIMARY KEY,
+                khr_per_usd REAL NOT NULL
+            )
+        """
+        )
 
-    conn.commit()
-    conn.close()
+        # history pre-aggregated per business date (and shift) and per month, kept in step with
+        # history on every write so summaries and reports don't have to scan it
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_rollups (
+                chat_id INTEGER,
+                business_date TEXT,
+                shift TEXT,
+                currency TEXT,
+                total INTEGER,
+                invoices INTEGER,
+                PRIMARY KEY (chat_id, business_date, shift, currency)
+            )
+        """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS monthly_rollups (
+                chat_id INTEGER,
+                month TEXT,    -- YYYY-MM of the business date
+                currency TEXT,
+                total INTEGER,
+                invoices INTEGER,
+                PRIMARY KEY (chat_id, month, currency)
+            )
+        """
+        )
+
+        # A chat's own shift start times (HH:MM); chats without rows use the default schedule
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS shift_schedules (
+                chat_id INTEGER,
+                shift TEXT,
+                start TEXT NOT NULL,
+                PRIMARY KEY (chat_id, shift)
+            )
+        """
+        )
+
+        # Add business_date if older DB didn’t have it
+        try:
+            cursor.execute("SELECT business_date FROM history LIMIT 1")
+        except sqlite3.OperationalError:
+            cursor.execute("ALTER TABLE history ADD COLUMN business_date TEXT")
+
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version < 2:
+            # Runs before the minor-units rebuild, which copies into the keyed old_totals;
+            # SUM works the same on REAL and INTEGER amounts.
+            _merge_old_totals(cursor)
+        if version < 1:
+            # REAL amounts in currency units -> INTEGER minor units
+            _migrate_to_minor_units(cursor)
+            _bump_history_rev(conn)
+        if version < 3:
+            # Rollups cover exactly the history folded into totals; rows above the mark are
+            # folded into both now rather than counted twice by the next catch-up
+            if _get_meta(conn, TOTALS_HWM_KEY) is not None:
+                _fold_new_history(conn)
+            _rebuild_rollups(conn)
+        if version < SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        for ddl in INDEXES:
+            cursor.execute(ddl)
+
+    with DB.serialized() as conn:
+        conn.execute("PRAGMA optimize")  # refresh planner stats for new/changed indexes
+    load_shift_schedules()
 
 
 # ==============================
 # ---------- Shifts ------------
 # ==============================
-# Shift windows requested:
-# shift 1: 06:00–14:00
-# shift 2: 14:01–20:00
-# shift 3: 20:01–06:00 (crosses midnight)
+# Shifts in business-day order. The business day starts when shift1 starts, so the
+# night shift's hours after midnight still belong to the previous business date.
+SHIFT_ORDER = ("shift1", "shift2", "shift3")
+# Default start times of shift1..shift3; chats can set their own with /shifts.
+# These are the boundaries the bot has always applied: 06:00–18:00, 18:00–22:00, 22:00–06:00.
+DEFAULT_SHIFT_STARTS = os.getenv("SHIFT_STARTS", "06:00,18:00,22:00")
+SHIFT_START_RE = re.compile(r"([01]?\d|2[0-3]):([0-5]\d)")
 
-SHIFT1_START = time(6, 0, 0)
-SHIFT1_END = time(18, 0, 0)
-SHIFT2_START = time(18, 1, 0)
-SHIFT2_END = time(22, 0, 0)
-SHIFT3_START = time(20, 1, 0)
-SHIFT3_END = time(6, 0, 0)  # next day
 
-def get_shift_and_business_date(now_dt: datetime | None = None):
+class ShiftSchedule:
     """
-    Returns (shift_name, business_date_str)
-    business_date handles the midnight crossover for shift3.
+    Shift start times compiled into a sorted table of minutes since the business-day start:
+    resolving a time is one subtraction (the business-date offset) and a bisect. Shifts are
+    half-open [start, next start) in wall-clock time. The last answer is kept together with the
+    span it holds for, so the current shift is only recomputed once a boundary has passed.
     """
-    now_dt = now_dt or datetime.now()
-    t = now_dt.time()
-    today = now_dt.date()
 
-    if SHIFT1_START <= t <= SHIFT1_END:
-        return "shift1", today.strftime("%Y-%m-%d")
-    if SHIFT2_START <= t <= SHIFT2_END:
-        return "shift2", today.strftime("%Y-%m-%d")
+    def __init__(self, starts: list[str]):
+        if len(starts) != len(SHIFT_ORDER):
+            raise ValueError(f"Need {len(SHIFT_ORDER)} start times (HH:MM), one per shift.")
+        minutes = []
+        for value in starts:
+            m = SHIFT_START_RE.fullmatch(value)
+            if not m:
+                raise ValueError(f"Bad start time: {value}")
+            minutes.append(int(m.group(1)) * 60 + int(m.group(2)))
+        self.starts = tuple(f"{m // 60:02d}:{m % 60:02d}" for m in minutes)
+        self.offset = timedelta(minutes=minutes[0])
+        self._bounds = [(m - minutes[0]) % (24 * 60) for m in minutes]
+        if self._bounds != sorted(set(self._bounds)):
+            raise ValueError("Start times must be distinct and follow the shift order around the clock.")
+        self._memo: tuple = (None, None, None)  # (shift start, next boundary, (shift, business_date))
+
+    def _lookup(self, wall: datetime) -> tuple:
+        start, end, result = memo = self._memo
+        if start is not None and start <= wall < end:
+            return memo
+        shifted = wall - self.offset
+        index = bisect.bisect_right(self._bounds, shifted.hour * 60 + shifted.minute) - 1
+        day_start = datetime(shifted.year, shifted.month, shifted.day) + self.offset
+        bounds = [*self._bounds, 24 * 60]
+        result = (SHIFT_ORDER[index], shifted.date().isoformat())
+        self._memo = memo = (day_start + timedelta(minutes=bounds[index]), day_start + timedelta(minutes=bounds[index + 1]), result)
+        return memo
+
+    def resolve(self, now_dt: datetime) -> tuple[str, str]:
+        """(shift, business_date) at now_dt (an aware time is taken at its own wall clock)."""
+        return self._lookup(now_dt.replace(tzinfo=None))[2]
+
+    def previous(self, now_dt: datetime) -> tuple[str, str]:
+        """(shift, business_date) of the shift before the one at now_dt."""
+        start = self._lookup(now_dt.replace(tzinfo=None))[0]
+        return self.resolve(start - timedelta(minutes=1))
+
+    def describe(self) -> str:
+        return ", ".join(f"{shift} {start}" for shift, start in zip(SHIFT_ORDER, self.starts))
+
+
+SHIFT_SCHEDULE = ShiftSchedule(DEFAULT_SHIFT_STARTS.split(","))
+# chat_id -> the chat's own schedule (rows of shift_schedules, loaded by load_shift_schedules)
+CHAT_SHIFT_SCHEDULES: dict[int, ShiftSchedule] = {}
+
+
+def shift_schedule(chat_id: int | None = None) -> ShiftSchedule:
+    return CHAT_SHIFT_SCHEDULES.get(chat_id, SHIFT_SCHEDULE)
+
+
+def get_shift_and_business_date(now_dt: datetime | None = None, chat_id: int | None = None):
+    """
+    Returns (shift_name, business_date_str) under the chat's schedule (the default one if None),
+    now in BOT_TIMEZONE unless now_dt is given. business_date handles the midnight crossover for shift3.
+    """
+    return shift_schedule(chat_id).resolve(now_dt or local_now())
+
+
+def load_shift_schedules():
+    by_chat: dict[int, dict] = {}
+    with DB.read() as conn:
+        for chat_id, shift, start in conn.execute("SELECT chat_id, shift, start FROM shift_schedules"):
+            by_chat.setdefault(chat_id, {})[shift] = start
+    for chat_id in set(CHAT_SHIFT_SCHEDULES) - set(by_chat):
+        del CHAT_SHIFT_SCHEDULES[chat_id]
+    for chat_id, starts in by_chat.items():
+        try:
+            CHAT_SHIFT_SCHEDULES[chat_id] = ShiftSchedule([starts.get(shift, "") for shift in SHIFT_ORDER])
+        except ValueError as e:
+            print(f"⚠️ Ignoring the shift schedule of chat {chat_id}: {e}")
+
+
+def set_shift_schedule(chat_id: int, schedule: ShiftSchedule | None):
+    """Store a chat's own shift schedule, or drop it (None) to fall back to the default."""
+    with DB.write() as conn:
+        conn.execute("DELETE FROM shift_schedules WHERE chat_id = ?", (chat_id,))
+        if schedule:
+            conn.executemany(
+                "INSERT INTO shift_schedules (chat_id, shift, start) VALUES (?, ?, ?)",
+                [(chat_id, shift, start) for shift, start in zip(SHIFT_ORDER, schedule.starts)],
+            )
+    if schedule:
+        CHAT_SHIFT_SCHEDULES[chat_id] = schedule
+    else:
+        CHAT_SHIFT_SCHEDULES.pop(chat_id, None)
 
-    # Shift 3:
-    # - from 20:01 -> 23:59 -> business_date = today
-    # - from 00:00 -> 06:00 -> business_date = yesterday
-    if t >= SHIFT3_START:  # 20:01–23:59
-        return "shift3", today.strftime("%Y-%m-%d")
-    # 00:00–06:00
-    if t < SHIFT3_END:
-        biz = (today - timedelta(days=1)).strftime("%Y-%m-%d")
-        return "shift3", biz
 
-    # Fallback (shouldn’t reach)
-    return "shift3", today.strftime("%Y-%m-%d")
+def get_today_str() -> str:
+    return local_now().date().isoformat()
 
 
-def get_today_str() -> str:
-    return datetime.now().strftime("%Y-%m-%d")
+# Business dates as typed in command arguments
+DATE_ARG_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
 
 
 # ==============================
 # ---- Recalculate Totals ------
 # ==============================
+# History rows with id <= this mark are already folded into totals (stored in meta).
+TOTALS_HWM_KEY = "totals_hwm"
+# Bumped whenever existing history rows are rewritten in place (appends don't count).
+HISTORY_REV_KEY = "history_rev"
+# JSON list of [chat_id or null, from, to] ranges /rezone has already rewritten.
+REZONED_KEY = "rezoned_ranges"
+
+_FOLD_HISTORY_SQL = """
+    INSERT INTO totals (chat_id, date, shift, currency, total, invoices)
+    SELECT chat_id, business_date, shift, currency, COALESCE(SUM(amount), 0), COUNT(*)
+    FROM history
+    WHERE {where}
+    GROUP BY chat_id, business_date, shift, currency
+    ON CONFLICT (chat_id, date, shift, currency) DO UPDATE
+    SET total = total + excluded.total, invoices = invoices + excluded.invoices
+"""
+# Totals rebuilt from history: what history holds per key minus what was moved to old_totals,
+# and nothing (rather than negative totals) for a key old_totals already covers entirely
+_REBUILD_TOTALS_SQL = """
+    INSERT INTO {table} (chat_id, date, shift, currency, total, invoices)
+    SELECT h.chat_id, h.business_date, h.shift, h.currency,
+           CASE WHEN COALESCE(o.invoices, 0) >= h.invoices THEN 0 ELSE h.total - COALESCE(o.total, 0) END,
+           MAX(h.invoices - COALESCE(o.invoices, 0), 0)
+    FROM (SELECT chat_id, business_date, shift, currency, COALESCE(SUM(amount), 0) AS total, COUNT(*) AS invoices
+          FROM history
+          WHERE {where}
+          GROUP BY chat_id, business_date, shift, currency) AS h
+    LEFT JOIN old_totals AS o
+      ON o.chat_id = h.chat_id AND o.date = h.business_date AND o.shift = h.shift AND o.currency = h.currency
+"""
+_FOLD_DAILY_ROLLUPS_SQL = """
+    INSERT INTO daily_rollups (chat_id, business_date, shift, currency, total, invoices)
+    SELECT chat_id, business_date, shift, currency, COALESCE(SUM(amount), 0), COUNT(*)
+    FROM history
+    WHERE {where}
+    GROUP BY chat_id, business_date, shift, currency
+    ON CONFLICT (chat_id, business_date, shift, currency) DO UPDATE
+    SET total = total + excluded.total, invoices = invoices + excluded.invoices
+"""
+_FOLD_MONTHLY_ROLLUPS_SQL = """
+    INSERT INTO monthly_rollups (chat_id, month, currency, total, invoices)
+    SELECT chat_id, substr(business_date, 1, 7), currency, COALESCE(SUM(amount), 0), COUNT(*)
+    FROM history
+    WHERE {where}
+    GROUP BY chat_id, substr(business_date, 1, 7), currency
+    ON CONFLICT (chat_id, month, currency) DO UPDATE
+    SET total = total + excluded.total, invoices = invoices + excluded.invoices
+"""
+
+
+def _get_meta(conn: sqlite3.Connection, key: str, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def _set_meta(conn: sqlite3.Connection, key: str, value):
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+        (key, value),
+    )
+
+
+def _bump_history_rev(conn: sqlite3.Connection):
+    """Record that existing history rows were rewritten, so cached exports get rebuilt."""
+    _set_meta(conn, HISTORY_REV_KEY, int(_get_meta(conn, HISTORY_REV_KEY, 0)) + 1)
+
+
+def _max_history_id(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+
+
+def _scope_sql(chat_id: int | None, date_from: str | None, date_to: str | None, date_column: str) -> tuple[str, list]:
+    """WHERE fragment (and params) limiting rows to a chat and/or an inclusive business-date range."""
+    clauses, params = [], []
+    if chat_id is not None:
+        clauses.append("chat_id = ?")
+        params.append(chat_id)
+    if date_from:
+        clauses.append(f"{date_column} >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append(f"{date_column} <= ?")
+        params.append(date_to)
+    return " AND ".join(clauses) or "1", params
+
+
+def _fold_new_history(conn: sqlite3.Connection) -> int:
+    """Add history rows above the high-water mark to totals; returns how many rows were folded in."""
+    hwm = int(_get_meta(conn, TOTALS_HWM_KEY, 0))
+    top = _max_history_id(conn)
+    if top <= hwm:
+        return 0
+    for sql in (_FOLD_HISTORY_SQL, _FOLD_DAILY_ROLLUPS_SQL, _FOLD_MONTHLY_ROLLUPS_SQL):
+        conn.execute(sql.format(where="id > ? AND id <= ?"), (hwm, top))
+    folded = conn.execute("SELECT COUNT(*) FROM history WHERE id > ? AND id <= ?", (hwm, top)).fetchone()[0]
+    _set_meta(conn, TOTALS_HWM_KEY, top)
+    return folded
+
+
+def _rebuild_rollups(conn: sqlite3.Connection, chat_id: int | None = None, date_from: str | None = None, date_to: str | None = None):
+    """Recompute the rollups of a chat and/or business-date range from history (monthly ones for whole months)."""
+    where, params = _scope_sql(chat_id, date_from, date_to, "business_date")
+    conn.execute(f"DELETE FROM daily_rollups WHERE {where}", params)
+    conn.execute(_FOLD_DAILY_ROLLUPS_SQL.format(where=where), params)
+    month_from, month_to = date_from and date_from[:7], date_to and date_to[:7]
+    where, params = _scope_sql(chat_id, month_from, month_to, "month")
+    conn.execute(f"DELETE FROM monthly_rollups WHERE {where}", params)
+    # "-31" bounds every month as a string, and keeps the filter on idx_history_chat_day
+    where, params = _scope_sql(chat_id, month_from and f"{month_from}-01", month_to and f"{month_to}-31", "business_date")
+    conn.execute(_FOLD_MONTHLY_ROLLUPS_SQL.format(where=where), params)
+
+
 def recalc_totals_from_history():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    """
+    Rebuild all totals from history in one transaction: a single INSERT ... SELECT ... GROUP BY
+    fills a shadow table, which then replaces totals. Readers keep seeing the old totals until commit.
+    What was already moved to old_totals is left out, so rolled-over shifts aren't counted twice.
+    The rollup tables are rebuilt in the same transaction.
+    """
+    with write_queue_paused(), _write_through() as conn:
+        conn.execute("DROP TABLE IF EXISTS totals_rebuild")
+        conn.execute(TOTALS_DDL.format(name="totals_rebuild"))
+        conn.execute(_REBUILD_TOTALS_SQL.format(table="totals_rebuild", where="1"))
+        conn.execute("DROP TABLE totals")
+        conn.execute("ALTER TABLE totals_rebuild RENAME TO totals")
+        _rebuild_rollups(conn)
+        _set_meta(conn, TOTALS_HWM_KEY, _max_history_id(conn))
+        TOTALS_CACHE.clear()
 
-    cursor.execute("DELETE FROM totals")
+    print("🔄 Totals recalculated from history.")
 
-    cursor.execute(
+
+def recalc_totals_incremental() -> int:
+    """
+    Fold only history rows added since the last recalc/ingest into totals (one INSERT ... SELECT).
+    Falls back to a full rebuild when no high-water mark has been recorded yet.
+    Returns the number of history rows folded in.
+    """
+    with write_queue_paused(), _write_through() as conn:
+        has_mark = _get_meta(conn, TOTALS_HWM_KEY) is not None
+        if has_mark:
+            folded = _fold_new_history(conn)
+            if folded:
+                TOTALS_CACHE.clear()
+    if not has_mark:
+        recalc_totals_from_history()
+        return -1
+    print(f"🔄 Folded {folded} new history rows into totals.")
+    return folded
+
+
+def recalc_totals_scoped(chat_id: int | None = None, date_from: str | None = None, date_to: str | None = None):
+    """
+    Rebuild totals (and rollups) for one chat and/or business-date range from history with a
+    single INSERT ... SELECT each; rows outside the scope are left as they are.
+    """
+    with write_queue_paused(), _write_through(chat_id) as conn:
+        _recalc_scope(conn, chat_id, date_from, date_to)
+        if chat_id is None:
+            TOTALS_CACHE.clear()
+        else:
+            TOTALS_CACHE.invalidate(chat_id)
+
+
+def _recalc_scope(conn: sqlite3.Connection, chat_id: int | None, date_from: str | None, date_to: str | None):
+    # Catch up first so every history row in scope is at or below the mark afterwards
+    _fold_new_history(conn)
+    where, params = _scope_sql(chat_id, date_from, date_to, "date")
+    conn.execute(f"DELETE FROM totals WHERE {where}", params)
+    where, params = _scope_sql(chat_id, date_from, date_to, "business_date")
+    conn.execute(_REBUILD_TOTALS_SQL.format(table="totals", where=where), params)
+    _rebuild_rollups(conn, chat_id, date_from, date_to)
+
+
+def rezone_history(source_zone: str, chat_id: int | None, date_from: str, date_to: str) -> int:
+    """
+    Re-derive history rows that were stamped in source_zone's wall-clock time (e.g. "UTC" when the
+    bot ran on a UTC server without BOT_TIMEZONE): datetime is converted to BOT_TIMEZONE and
+    business_date/shift are recomputed with the chat's schedule. date_from/date_to (required)
+    select rows by their stored calendar date. Totals of every business date touched are rebuilt
+    in the same transaction, and rolled-over receipts carry their old_totals share with them.
+    Returns the number of rows rewritten. This isn't idempotent, so each range that rewrote rows
+    is recorded in meta and a range overlapping one already rezoned raises ValueError.
+    """
+    if not (date_from and date_to):
+        raise ValueError("Give the date range to rezone.")
+    source = ZoneInfo(source_zone)
+    clauses, params = ["datetime >= ?", "datetime < ?"], [date_from, (date.fromisoformat(date_to) + timedelta(days=1)).isoformat()]
+    if chat_id is not None:
+        clauses.append("chat_id = ?")
+        params.append(chat_id)
+    where = " AND ".join(clauses)
+
+    with write_queue_paused(), _write_through(chat_id) as conn:
+        done = json.loads(_get_meta(conn, REZONED_KEY, "[]"))
+        for done_chat, done_from, done_to in done:
+            if (done_chat is None or chat_id is None or done_chat == chat_id) and done_from <= date_to and date_from <= done_to:
+                scope = "all chats" if done_chat is None else f"chat {done_chat}"
+                raise ValueError(f"{done_from} → {done_to} ({scope}) was already rezoned.")
+
+        rows = conn.execute(
+            f"SELECT id, chat_id, datetime, business_date, shift, currency, amount FROM history WHERE {where}", params
+        ).fetchall()
+        if not rows:
+            return 0
+        # A rollover moves everything recorded so far, so a key's old_totals holds its earliest
+        # receipts: the first old_totals.invoices rows of the key are the rolled-over ones
+        rolled = set()
+        for key in {(row[1], row[3], row[4], row[5]) for row in rows}:
+            old = conn.execute(
+                "SELECT invoices FROM old_totals WHERE chat_id = ? AND date = ? AND shift = ? AND currency = ?", key
+            ).fetchone()
+            if old and old[0] > 0:
+                rolled.update(
+                    row_id
+                    for (row_id,) in conn.execute(
+                        """SELECT id FROM history WHERE chat_id = ? AND business_date = ? AND shift = ? AND currency = ?
+                           ORDER BY datetime, id LIMIT ?""",
+                        (*key, old[0]),
+                    )
+                )
+
+        updates, dates, moved = [], set(), {}
+        for row_id, row_chat, stamp, old_date, old_shift, currency, amount in rows:
+            local = datetime.fromisoformat(stamp).replace(tzinfo=source).astimezone(BOT_TIMEZONE)
+            shift, business_date = get_shift_and_business_date(local, row_chat)
+            updates.append((local.strftime("%Y-%m-%d %H:%M:%S"), business_date, shift, row_id))
+            dates.update(d for d in (old_date, business_date) if d)
+            if row_id in rolled and (business_date, shift) != (old_date, old_shift):
+                # Its share of old_totals follows it to the new business date and shift
+                for key, sign in (((row_chat, old_date, old_shift, currency), -1), ((row_chat, business_date, shift, currency), 1)):
+                    delta = moved.setdefault(key, [0, 0])
+                    delta[0] += sign * amount
+                    delta[1] += sign
+        conn.executemany("UPDATE history SET datetime = ?, business_date = ?, shift = ? WHERE id = ?", updates)
+        conn.executemany(
+            """INSERT INTO old_totals (chat_id, date, shift, currency, total, invoices)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (chat_id, date, shift, currency) DO UPDATE
+               SET total = total + excluded.total, invoices = invoices + excluded.invoices""",
+            [(*key, total, invoices) for key, (total, invoices) in moved.items()],
+        )
+        _bump_history_rev(conn)
+        _recalc_scope(conn, chat_id, min(dates), max(dates))
+        _set_meta(conn, REZONED_KEY, json.dumps([*done, [chat_id, date_from, date_to]]))
+        for cache in (TOTALS_CACHE, OLD_TOTALS_CACHE):
+            if chat_id is None:
+                cache.clear()
+            else:
+                cache.invalidate(chat_id)
+    return len(updates)
+
+
+# ==============================
+# -------- Totals Cache --------
+# ==============================
+# Cached business days per cache; least recently used days are evicted first.
+TOTALS_CACHE_SIZE = int(os.getenv("TOTALS_CACHE_SIZE", "1024"))
+
+
+def _empty_totals() -> dict:
+    return {"USD": {"total": 0, "invoices": 0}, "KHR": {"total": 0, "invoices": 0}}
+
+
+def _sum_shifts(shifts) -> dict:
+    data = _empty_totals()
+    for totals in shifts:
+        for currency, entry in totals.items():
+            acc = data.setdefault(currency, {"total": 0, "invoices": 0})
+            acc["total"] += entry["total"]
+            acc["invoices"] += entry["invoices"]
+    return data
+
+
+def _copy_shifts(shifts: dict) -> dict:
+    return {shift: {currency: dict(entry) for currency, entry in totals.items()} for shift, totals in shifts.items()}
+
+
+class TotalsCache:
+    """
+    LRU of per-day totals keyed by (chat_id, business_date); each entry maps shift -> totals dict.
+    The business date's exchange rate is loaded with the day and kept next to it.
+    Entries are filled under the writer lock and updated write-through inside the write
+    transactions that change them, so a cached day always matches committed data.
+    """
+
+    def __init__(self, maxsize: int = TOTALS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        self._rates: dict[str, float | None] = {}  # business_date -> KHR per USD
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> tuple[dict, float | None] | None:
+        """Copy of the cached ({shift: totals}, rate) for key, or None (counted as a miss)."""
+        with self._lock:
+            shifts = self._entries.get(key)
+            if shifts is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return _copy_shifts(shifts), self._rates.get(key[1])
+
+    def __contains__(self, key: tuple) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: tuple, shifts: dict, rate: float | None = None):
+        with self._lock:
+            self._entries[key] = _copy_shifts(shifts)
+            self._rates[key[1]] = rate
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def set_shift(self, key: tuple, shift: str, totals: dict):
+        """Overwrite one shift of a cached day; ignored when the day is not cached."""
+        with self._lock:
+            shifts = self._entries.get(key)
+            if shifts is not None:
+                shifts[shift] = {currency: dict(entry) for currency, entry in totals.items()}
+
+    def set_currencies(self, key: tuple, shift: str, values: dict):
+        """Overwrite {currency: (total, invoices)} in one shift of a cached day; ignored when the day is not cached."""
+        with self._lock:
+            shifts = self._entries.get(key)
+            if shifts is not None:
+                totals = shifts.setdefault(shift, _empty_totals())
+                for currency, (total, invoices) in values.items():
+                    totals[currency] = {"total": total, "invoices": invoices}
+
+    def add(self, key: tuple, shift: str, deltas: dict) -> dict | None:
         """
-        SELECT chat_id, business_date, shift, currency, SUM(amount) AS s, COUNT(*) AS n
-        FROM history
-        GROUP BY chat_id, business_date, shift, currency
+        Add {currency: (total, invoices)} to one shift of a cached day.
+        Returns that shift's new totals, or None when the day is not cached.
         """
-    )
-    rows = cursor.fetchall()
+        with self._lock:
+            shifts = self._entries.get(key)
+            if shifts is None:
+                return None
+            totals = shifts.setdefault(shift, _empty_totals())
+            for currency, (total, invoices) in deltas.items():
+                entry = totals.setdefault(currency, {"total": 0, "invoices": 0})
+                entry["total"] += total
+                entry["invoices"] += invoices
+            return {currency: dict(entry) for currency, entry in totals.items()}
+
+    def zero(self, key: tuple, shift: str | None = None):
+        """Zero one shift (or every shift) of a cached day."""
+        with self._lock:
+            shifts = self._entries.get(key)
+            if shifts is None:
+                return
+            for name in [shift] if shift else list(shifts):
+                shifts[name] = _empty_totals()
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == chat_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rates.clear()
+
+    def stats(self) -> str:
+        with self._lock:
+            lookups = self.hits + self.misses
+            ratio = self.hits / lookups * 100 if lookups else 0.0
+            return f"{len(self._entries)}/{self.maxsize} days, {self.hits} hits, {self.misses} misses ({ratio:.1f}% hit)"
+
+
+TOTALS_CACHE = TotalsCache()
+OLD_TOTALS_CACHE = TotalsCache()
+
+
+def _read_day_shifts(conn: sqlite3.Connection, table: str, chat_id: int, date_str: str) -> tuple[dict, float | None]:
+    """({shift: totals}, KHR per USD) for one business day; the rate comes back with the aggregates."""
+    rows = conn.execute(
+        f"""SELECT rate.khr_per_usd, day.shift, day.currency, day.total, day.invoices
+            FROM (SELECT (SELECT khr_per_usd FROM exchange_rates WHERE date <= :date
+                          ORDER BY date DESC LIMIT 1) AS khr_per_usd) AS rate
+            LEFT JOIN (SELECT shift, currency, SUM(total) AS total, SUM(invoices) AS invoices
+                       FROM {table} WHERE chat_id = :chat_id AND date = :date
+                       GROUP BY shift, currency) AS day""",
+        {"chat_id": chat_id, "date": date_str},
+    ).fetchall()
+    shifts: dict[str, dict] = {}
+    for _rate, shift, currency, total, invoices in rows:
+        if currency:
+            shifts.setdefault(shift, _empty_totals())[currency] = {
+                "total": int(total or 0),
+                "invoices": int(invoices or 0),
+            }
+    return shifts, rows[0][0]
 
-    for chat_id, biz_date, shift, currency, total, invoices in rows:
-        cursor.execute(
-            """INSERT OR REPLACE INTO totals
-               (chat_id, date, shift, currency, total, invoices)
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (chat_id, biz_date, shift, currency, float(total or 0), int(invoices or 0)),
-        )
 
-    conn.commit()
-    conn.close()
-    print("🔄 Totals recalculated from history.")
+def _cached_day(cache: TotalsCache, table: str, chat_id: int, date_str: str) -> tuple[dict, float | None]:
+    """({shift: totals}, rate) for one business day, loading it into the cache on a miss."""
+    key = (chat_id, date_str)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    # Loaded under the writer lock (and with queued receipts written out) so no write
+    # can land between the read and the put.
+    paused = write_queue_paused() if cache is TOTALS_CACHE else nullcontext()
+    with paused, DB.serialized() as conn:
+        shifts, rate = _read_day_shifts(conn, table, chat_id, date_str)
+        cache.put(key, shifts, rate)
+    return shifts, rate
+
+
+def _with_combined(totals: dict, rate: float | None) -> dict:
+    """
+    Add totals["combined"]: USD and KHR summed in each currency at the day's rate, in minor
+    units ({"USD": cents, "KHR": riel, "rate": KHR per USD}), or None when no rate is set.
+    """
+    totals["combined"] = None
+    if rate:
+        usd, khr = totals["USD"]["total"], totals["KHR"]["total"]
+        cents = MINOR_UNITS["USD"]
+        totals["combined"] = {"USD": usd + round(khr * cents / rate), "KHR": khr + round(usd * rate / cents), "rate": rate}
+    return totals
+
+
+@contextmanager
+def _write_through(chat_id: int | None = None):
+    """DB.write() for transactions that also update the caches; drops the chat's cached days if it fails."""
+    try:
+        with DB.write() as conn:
+            yield conn
+    except BaseException:
+        for cache in (TOTALS_CACHE, OLD_TOTALS_CACHE):
+            if chat_id is None:
+                cache.clear()
+            else:
+                cache.invalidate(chat_id)
+        raise
 
 
 # ==============================
 # ------- Data Operations ------
 # ==============================
-def update_total(chat_id: int, currency: str, amount: float) -> bool:
-    now_dt = datetime.now()
-    shift, business_date = get_shift_and_business_date(now_dt)
+def _totals_dict(rows) -> dict:
+    data = _empty_totals()
+    for currency, total, invoices in rows:
+        if currency:
+            data[currency] = {
+                "total": int(total or 0),
+                "invoices": int(invoices or 0),
+            }
+    return data
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
 
-    # Permanent log (with business_date)
-    cursor.execute(
+def _apply_history_rows(cursor: sqlite3.Cursor, rows: list[tuple]):
+    """
+    Append rows (chat_id, datetime, business_date, shift, currency, amount) to history
+    and fold them into totals, one UPSERT per (chat_id, date, shift, currency).
+    Runs inside the caller's write transaction.
+    """
+    conn = cursor.connection
+    hwm = _get_meta(conn, TOTALS_HWM_KEY)
+    if hwm is not None and hwm < _max_history_id(conn):
+        # Rows were added behind our back: fold them in first so the mark can move past ours
+        _fold_new_history(conn)
+        TOTALS_CACHE.clear()
+
+    cursor.executemany(
         """INSERT INTO history (chat_id, datetime, business_date, shift, currency, amount)
            VALUES (?, ?, ?, ?, ?, ?)""",
-        (
-            chat_id,
-            now_dt.strftime("%Y-%m-%d %H:%M:%S"),
-            business_date,
-            shift,
-            currency,
-            float(amount),
-        ),
+        rows,
     )
-
-    # Update running totals
-    cursor.execute(
-        """SELECT total, invoices FROM totals
-           WHERE chat_id = ? AND date = ? AND shift = ? AND currency = ?""",
-        (chat_id, business_date, shift, currency),
+    # These rows are folded into totals below, so the recalc high-water mark moves past them
+    if hwm is not None:
+        _set_meta(conn, TOTALS_HWM_KEY, _max_history_id(conn))
+
+    deltas: dict[tuple, list] = {}
+    for chat_id, _dt, business_date, shift, currency, amount in rows:
+        delta = deltas.setdefault((chat_id, business_date, shift, currency), [0, 0])
+        delta[0] += amount
+        delta[1] += 1
+
+    # Update running totals in place: one atomic statement per key, no read-modify-write race
+    cursor.executemany(
+        """INSERT INTO totals (chat_id, date, shift, currency, total, invoices)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (chat_id, date, shift, currency) DO UPDATE
+           SET total = total + excluded.total, invoices = invoices + excluded.invoices""",
+        [(*key, total, invoices) for key, (total, invoices) in deltas.items()],
+    )
+    # The rollups take the same deltas (per month for monthly_rollups)
+    cursor.executemany(
+        """INSERT INTO daily_rollups (chat_id, business_date, shift, currency, total, invoices)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (chat_id, business_date, shift, currency) DO UPDATE
+           SET total = total + excluded.total, invoices = invoices + excluded.invoices""",
+        [(*key, total, invoices) for key, (total, invoices) in deltas.items()],
+    )
+    months: dict[tuple, list] = {}
+    for (chat_id, business_date, _shift, currency), (total, invoices) in deltas.items():
+        delta = months.setdefault((chat_id, business_date[:7], currency), [0, 0])
+        delta[0] += total
+        delta[1] += invoices
+    cursor.executemany(
+        """INSERT INTO monthly_rollups (chat_id, month, currency, total, invoices)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (chat_id, month, currency) DO UPDATE
+           SET total = total + excluded.total, invoices = invoices + excluded.invoices""",
+        [(*key, total, invoices) for key, (total, invoices) in months.items()],
     )
-    row = cursor.fetchone()
 
-    if row:
-        total, invoices = row
-        cursor.execute(
-            """UPDATE totals
-               SET total = ?, invoices = ?
-               WHERE chat_id = ? AND date = ? AND shift = ? AND currency = ?""",
-            (
-                float(total) + float(amount),
-                int(invoices) + 1,
-                chat_id,
-                business_date,
-                shift,
-                currency,
-            ),
-        )
-    else:
-        cursor.execute(
-            """INSERT INTO totals (chat_id, date, shift, currency, total, invoices)
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (chat_id, business_date, shift, currency, float(amount), 1),
-        )
 
-    conn.commit()
-    conn.close()
-    return True
+def _history_rows(chat_id: int, amounts: list[tuple[float, str]], now_dt: datetime | None = None):
+    """
+    Returns (shift, business_date, rows) for the history rows of one message received at now_dt.
+    """
+    now_dt = now_dt or local_now()
+    shift, business_date = get_shift_and_business_date(now_dt, chat_id)
+    stamp = now_dt.strftime("%Y-%m-%d %H:%M:%S")
+    rows = [(chat_id, stamp, business_date, shift, currency, to_minor(amount, currency)) for amount, currency in amounts]
+    return shift, business_date, rows
+
+
+def _read_shift_totals(conn: sqlite3.Connection, chat_id: int, date_str: str, shift: str) -> dict:
+    rows = conn.execute(
+        """SELECT currency, total, invoices FROM totals
+           WHERE chat_id = ? AND date = ? AND shift = ?""",
+        (chat_id, date_str, shift),
+    ).fetchall()
+    return _totals_dict(rows)
+
+
+def ingest_amounts(chat_id: int, amounts: list[tuple[float, str]], now_dt: datetime | None = None) -> dict:
+    """
+    Record every (amount, currency) of one message in a single transaction and
+    return the updated totals of the current shift, read inside that same transaction.
+    """
+    shift, business_date, rows = _history_rows(chat_id, amounts, now_dt)
+
+    with _write_through(chat_id) as conn:
+        _apply_history_rows(conn.cursor(), rows)  # Permanent log (with business_date) + running totals
+        totals = _read_shift_totals(conn, chat_id, business_date, shift)
+        TOTALS_CACHE.set_shift((chat_id, business_date), shift, totals)
+    return totals
 
 
 def get_totals(chat_id: int, date_str: str | None = None, shift: str | None = None):
     date_str = date_str or get_today_str()
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
+    shifts, rate = _cached_day(TOTALS_CACHE, "totals", chat_id, date_str)
     if shift:
-        cursor.execute(
-            """SELECT currency, total, invoices FROM totals
-               WHERE chat_id = ? AND date = ? AND shift = ?""",
-            (chat_id, date_str, shift),
-        )
-    else:
-        cursor.execute(
-            """SELECT currency, SUM(total), SUM(invoices) FROM totals
-               WHERE chat_id = ? AND date = ?
-               GROUP BY currency""",
-            (chat_id, date_str),
-        )
+        return _with_combined(shifts.get(shift) or _empty_totals(), rate)
+    return _with_combined(_sum_shifts(shifts.values()), rate)
 
-    rows = cursor.fetchall()
-    conn.close()
 
-    data = {"USD": {"total": 0.0, "invoices": 0}, "KHR": {"total": 0.0, "invoices": 0}}
-    for currency, total, invoices in rows:
-        if currency:
-            data[currency] = {
-                "total": float(total or 0),
-                "invoices": int(invoices or 0),
-            }
-    return data
+def _move_rows_to_old(conn: sqlite3.Connection, where: str, params) -> list[tuple]:
+    """
+    Add the non-zero totals rows matching `where` onto old_totals and zero them: two set-based
+    statements in the caller's write transaction, caches updated. Moving a row twice can't
+    duplicate it, since old_totals has one row per key. Returns the old_totals rows that changed
+    (chat_id, date, shift, currency, total, invoices), with their totals after the move.
+    """
+    where += " AND (total != 0 OR invoices != 0)"
+    rows = conn.execute(
+        f"""INSERT INTO old_totals (chat_id, date, shift, currency, total, invoices)
+            SELECT chat_id, date, shift, currency, total, invoices FROM totals WHERE {where}
+            ON CONFLICT (chat_id, date, shift, currency) DO UPDATE
+            SET total = total + excluded.total, invoices = invoices + excluded.invoices
+            RETURNING chat_id, date, shift, currency, total, invoices""",
+        params,
+    ).fetchall()
+    if not rows:
+        return rows
+    conn.execute(f"UPDATE totals SET total = 0, invoices = 0 WHERE {where}", params)
+
+    moved: dict[tuple, dict] = {}
+    for chat_id, date_str, shift, currency, total, invoices in rows:
+        moved.setdefault((chat_id, date_str, shift), {})[currency] = (total, invoices)
+    for (chat_id, date_str, shift), values in moved.items():
+        TOTALS_CACHE.zero((chat_id, date_str), shift)
+        OLD_TOTALS_CACHE.set_currencies((chat_id, date_str), shift, values)
+    return rows
 
 
 def move_to_old(chat_id: int, shift: str, date_str: str):
     """
     Move current shift totals for (chat_id, date_str, shift) to old_totals, then zero the active totals.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    with write_queue_paused(), _write_through(chat_id) as conn:
+        _move_rows_to_old(conn, "chat_id = ? AND date = ? AND shift = ?", (chat_id, date_str, shift))
 
-    cursor.execute(
-        """SELECT currency, total, invoices FROM totals
-           WHERE chat_id = ? AND date = ? AND shift = ?""",
-        (chat_id, date_str, shift),
-    )
-    rows = cursor.fetchall()
-
-    if rows:
-        for currency, total, invoices in rows:
-            cursor.execute(
-                """INSERT INTO old_totals (chat_id, date, shift, currency, total, invoices)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (chat_id, date_str, shift, currency, float(total or 0), int(invoices or 0)),
-            )
-        cursor.execute(
-            """UPDATE totals SET total = 0, invoices = 0
-               WHERE chat_id = ? AND date = ? AND shift = ?""",
-            (chat_id, date_str, shift),
+
+# meta key (plus ":<chat_id>" for chats with their own schedule) -> "<business_date> <shift>"
+# of the shift that was current at the last automatic rollover
+ROLLOVER_KEY = "rolled_over_to"
+
+
+def _shift_key(shift: str, date_str: str) -> str:
+    # Orders shifts by business date, then SHIFT_ORDER (shift1 < shift2 < shift3)
+    return f"{date_str} {shift}"
+
+
+def _rollover_meta_key(chat_id: int | None) -> str:
+    return ROLLOVER_KEY if chat_id is None else f"{ROLLOVER_KEY}:{chat_id}"
+
+
+def roll_over_ended_shifts(now_dt: datetime | None = None) -> list[tuple]:
+    """
+    Move the totals of every shift that ended since the last rollover to old_totals and zero
+    them (what "🆕 New Data" does for one chat), for all chats in one transaction. Each schedule's
+    progress is kept in meta, so a restart neither repeats a rollover nor skips one that came due
+    while the bot was down; the first run only rolls over the shift that just ended.
+    Returns the old_totals rows that changed (chat_id, date, shift, currency, total, invoices).
+    """
+    now_dt = now_dt or local_now()
+    schedules = {None: SHIFT_SCHEDULE, **CHAT_SHIFT_SCHEDULES}
+    current = {chat_id: _shift_key(*schedule.resolve(now_dt)) for chat_id, schedule in schedules.items()}
+    with DB.read() as conn:
+        done = dict(conn.execute("SELECT key, value FROM meta WHERE key LIKE ?", (ROLLOVER_KEY + "%",)).fetchall())
+    if all(done.get(_rollover_meta_key(chat_id)) == upto for chat_id, upto in current.items()):
+        return []
+
+    moved = []
+    with write_queue_paused(), _write_through() as conn:
+        for chat_id, schedule in schedules.items():
+            meta_key, upto = _rollover_meta_key(chat_id), current[chat_id]
+            since = _get_meta(conn, meta_key) or _shift_key(*schedule.previous(now_dt))
+            if since == upto:
+                continue
+            if chat_id is None:
+                others = ", ".join(str(c) for c in schedules if c is not None)
+                scope, params = (f"chat_id NOT IN ({others})" if others else "1"), []
+            else:
+                scope, params = "chat_id = ?", [chat_id]
+            where = f"""{scope} AND date BETWEEN ? AND ?
+                        AND date || ' ' || shift >= ? AND date || ' ' || shift < ?"""
+            params += [since[:10], upto[:10], since, upto]
+            moved += _move_rows_to_old(conn, where, params)
+            _set_meta(conn, meta_key, upto)
+    return moved
+
+
+def reset_totals(chat_id: int, date_str: str):
+    """
+    Zero every shift's active totals for (chat_id, date_str). History is untouched.
+    """
+    with write_queue_paused(), _write_through(chat_id) as conn:
+        conn.execute(
+            "UPDATE totals SET total = 0, invoices = 0 WHERE chat_id = ? AND date = ?",
+            (chat_id, date_str),
         )
+        TOTALS_CACHE.zero((chat_id, date_str))
 
-    conn.commit()
-    conn.close()
 
+def get_recent_history(limit: int = 50):
+    flush_write_queue()
+    with DB.read() as conn:
+        return conn.execute(
+            "SELECT id, chat_id, datetime, business_date, shift, currency, amount FROM history ORDER BY datetime DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
 
-def get_old_totals(chat_id: int, date_str: str | None = None):
+
+def get_old_totals(chat_id: int, date_str: str | None = None, shift: str | None = None):
     date_str = date_str or get_today_str()
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT currency, SUM(total), SUM(invoices)
-           FROM old_totals
-           WHERE chat_id = ? AND date = ?
-           GROUP BY currency""",
-        (chat_id, date_str),
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    shifts, rate = _cached_day(OLD_TOTALS_CACHE, "old_totals", chat_id, date_str)
+    if shift:
+        return _with_combined(shifts.get(shift) or _empty_totals(), rate)
+    return _with_combined(_sum_shifts(shifts.values()), rate)
 
-    data = {"USD": {"total": 0.0, "invoices": 0}, "KHR": {"total": 0.0, "invoices": 0}}
-    for currency, total, invoices in rows:
-        if currency:
-            data[currency] = {
-                "total": float(total or 0),
-                "invoices": int(invoices or 0),
-            }
-    return data
+
+def get_report_totals(chat_id: int, date_str: str, shift: str | None = None):
+    """
+    Everything recorded in one shift (or, without shift, the whole business day): the active
+    totals plus what was rolled over to old_totals, so a rollover doesn't change the figures.
+    """
+    live, rate = _cached_day(TOTALS_CACHE, "totals", chat_id, date_str)
+    closed, _rate = _cached_day(OLD_TOTALS_CACHE, "old_totals", chat_id, date_str)
+    if shift:
+        return _with_combined(_sum_shifts([live.get(shift, {}), closed.get(shift, {})]), rate)
+    return _with_combined(_sum_shifts([*live.values(), *closed.values()]), rate)
+
+
+def get_exchange_rate(date_str: str | None = None) -> tuple[str, float] | None:
+    """(effective since, KHR per USD) in force on a business date, or None."""
+    date_str = date_str or get_today_str()
+    with DB.read() as conn:
+        return conn.execute(
+            "SELECT date, khr_per_usd FROM exchange_rates WHERE date <= ? ORDER BY date DESC LIMIT 1",
+            (date_str,),
+        ).fetchone()
+
+
+def set_exchange_rate(khr_per_usd: float, date_str: str):
+    """Set the KHR per USD rate from date_str on (until the next later rate)."""
+    with write_queue_paused(), _write_through() as conn:
+        conn.execute(
+            """INSERT INTO exchange_rates (date, khr_per_usd) VALUES (?, ?)
+               ON CONFLICT (date) DO UPDATE SET khr_per_usd = excluded.khr_per_usd""",
+            (date_str, khr_per_usd),
+        )
+        # Every cached day on or after date_str may now use this rate
+        TOTALS_CACHE.clear()
+        OLD_TOTALS_CACHE.clear()
+
+
+# ==============================
+# ----- Write-behind Queue -----
+# ==============================
+# Optional group-commit mode for busy chats: receipts are acknowledged from memory and
+# written to history/totals in batches instead of one fsync'ing commit per message.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "250"))
+FLUSH_MAX_ROWS = int(os.getenv("FLUSH_MAX_ROWS", "200"))
+
+
+class WriteBehindQueue:
+    """
+    Buffers history rows in memory and flushes them in one transaction every
+    `interval_ms`, or as soon as `max_rows` are pending.
+    Queued amounts are applied to TOTALS_CACHE immediately, so receipt replies and
+    total lookups never wait for the database.
+    """
+
+    def __init__(self, interval_ms: int = FLUSH_INTERVAL_MS, max_rows: int = FLUSH_MAX_ROWS):
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._pending: list[tuple] = []
+        self._lock = threading.Lock()  # guards _pending and the cache updates made for it
+        self._flush_lock = threading.Lock()  # one flush at a time
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Rows stay queued and are retried on the next tick
+                print(f"Write-behind flush failed: {e}")
+
+    def enqueue(self, chat_id: int, amounts: list[tuple[float, str]], now_dt: datetime | None = None) -> dict:
+        """Queue one message's amounts; returns the chat's updated shift totals."""
+        shift, business_date, rows = _history_rows(chat_id, amounts, now_dt)
+        key = (chat_id, business_date)
+        deltas: dict[str, tuple] = {}
+        for _chat, _dt, _date, _shift, currency, amount in rows:
+            total, invoices = deltas.get(currency, (0, 0))
+            deltas[currency] = (total + amount, invoices + 1)
+
+        with self._lock:
+            totals = TOTALS_CACHE.add(key, shift, deltas)
+            if totals is not None:
+                return self._queue(rows, totals)
+
+        # Day not cached: write out what is pending so the DB is complete, then load it
+        with self._flush_lock, self._lock:
+            self._write_pending()
+            if key not in TOTALS_CACHE:
+                with DB.serialized() as conn:
+                    TOTALS_CACHE.put(key, *_read_day_shifts(conn, "totals", chat_id, business_date))
+            return self._queue(rows, TOTALS_CACHE.add(key, shift, deltas))
+
+    def _queue(self, rows: list[tuple], totals: dict) -> dict:
+        self._pending.extend(rows)
+        if len(self._pending) >= self.max_rows:
+            self._wake.set()
+        return totals
+
+    def _write(self, rows: list[tuple]):
+        with DB.write() as conn:
+            _apply_history_rows(conn.cursor(), rows)
+
+    def _write_pending(self):
+        # Caller holds _flush_lock and _lock
+        rows, self._pending = self._pending, []
+        if rows:
+            try:
+                self._write(rows)
+            except BaseException:
+                self._pending[:0] = rows
+                raise
+
+    def flush(self) -> int:
+        """Group-commit everything pending; returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            try:
+                self._write(rows)
+            except BaseException:
+                with self._lock:
+                    self._pending[:0] = rows
+                raise
+            return len(rows)
+
+    @contextmanager
+    def paused(self):
+        """Write out everything pending and hold off new receipts while the caller rewrites totals."""
+        with self._flush_lock, self._lock:
+            self._write_pending()
+            yield
+
+    def close(self):
+        """Stop the flusher and make everything queued durable (idempotent)."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self.flush() or self._thread is not None:
+            DB.checkpoint()
+        self._thread = None
+
+
+WRITE_QUEUE = WriteBehindQueue() if WRITE_BEHIND else None
+
+
+def flush_write_queue():
+    """Make queued receipts visible to plain DB reads (no-op unless WRITE_BEHIND is on)."""
+    if WRITE_QUEUE:
+        WRITE_QUEUE.flush()
+
+
+def write_queue_paused():
+    return WRITE_QUEUE.paused() if WRITE_QUEUE else nullcontext()
 
 
 # ==============================
 # --------- Exporting ----------
 # ==============================
-def export_db_to_excel() -> str:
-    conn = sqlite3.connect(DB_PATH)
+# Rows fetched per cursor page while streaming an export; memory stays bounded by this.
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "5000"))
+HISTORY_COLUMNS = ["id", "chat_id", "datetime", "business_date", "shift", "currency", "amount"]
+# Exported amounts are in currency units (12.5 USD), not the stored minor units
+HISTORY_SELECT = ", ".join(f"{AMOUNT_SQL} AS amount" if column == "amount" else column for column in HISTORY_COLUMNS)
+
+
+def _iter_pages(cursor: sqlite3.Cursor, size: int = EXPORT_PAGE_SIZE):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+def _write_xlsx(path: str, sheet: str, columns: list[str], pages):
+    # write_only: rows are streamed to disk as they are appended, never held as a whole sheet
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet)
+    ws.append(columns)
+    for rows in pages:
+        for row in rows:
+            ws.append(row)
+    wb.save(path)
+
+
+@dataclass(frozen=True)
+class ExportFilters:
+    """Which history rows an export covers; None means no restriction. Dates are inclusive business dates."""
+
+    chat_id: int | None = None
+    date_from: str | None = None
+    date_to: str | None = None
+    shift: str | None = None
+    currency: str | None = None
+
+    def where(self) -> tuple[str, list]:
+        # chat_id + business_date lead idx_history_chat_day, so the filter is an index range scan
+        where, params = _scope_sql(self.chat_id, self.date_from, self.date_to, "business_date")
+        if self.shift:
+            where += " AND shift = ?"
+            params.append(self.shift)
+        if self.currency:
+            where += " AND currency = ?"
+            params.append(self.currency)
+        return where, params
+
+    def describe(self) -> str:
+        parts = [f"chat {self.chat_id}" if self.chat_id is not None else "all chats"]
+        if self.date_from or self.date_to:
+            if self.date_from == self.date_to:
+                parts.append(self.date_from)
+            else:
+                parts.append(f"{self.date_from or '…'} → {self.date_to or '…'}")
+        else:
+            parts.append("all dates")
+        parts.extend(p for p in (self.shift, self.currency) if p)
+        return ", ".join(parts)
+
+    def filename(self, ext: str) -> str:
+        parts = ["history", str(self.chat_id) if self.chat_id is not None else "all"]
+        parts.extend(p for p in (self.date_from, self.date_to, self.shift, self.currency) if p)
+        return "_".join(dict.fromkeys(parts)) + f".{ext}"
+
+
+def parse_export_args(
+    args: list[str], current_chat_id: int, is_admin: bool, fmt: str = "xlsx"
+) -> tuple[ExportFilters, str]:
+    """
+    Export arguments -> (ExportFilters, format), defaulting to the current chat and `fmt`.
+    One date selects that day, two a range; shift1/shift2/shift3 and USD/KHR narrow further,
+    xlsx/csv/parquet pick the format. Admins may pass "all" or a chat id to export other chats.
+    """
+    chat_id, dates, shift, currency = current_chat_id, [], None, None
+    for arg in args:
+        low = arg.lower()
+        if low in EXPORT_FORMATS:
+            fmt = low
+        elif DATE_ARG_RE.fullmatch(arg):
+            dates.append(arg)
+        elif re.fullmatch(r"shift\d", low):
+            shift = low
+        elif low in ("usd", "khr"):
+            currency = low.upper()
+        elif low == "all" or re.fullmatch(r"-?\d+", arg):
+            if not is_admin:
+                raise ValueError("Only admins can export other chats.")
+            chat_id = None if low == "all" else int(arg)
+        else:
+            raise ValueError(f"Unknown argument: {arg}")
+    if len(dates) > 2:
+        raise ValueError("At most two dates (from, to).")
+    dates.sort()
+    filters = ExportFilters(
+        chat_id=chat_id,
+        date_from=dates[0] if dates else None,
+        date_to=dates[-1] if dates else None,
+        shift=shift,
+        currency=currency,
+    )
+    return filters, fmt
+
+
+def _write_csv_gz(path: str, sheet: str, columns: list[str], pages):
+    with gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=6) as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for rows in pages:
+            writer.writerows(rows)
+
+
+# Parquet column types (pyarrow type names); other columns are strings. Fixed up front so a page
+# that happens to be all NULL or all KHR can't decide a column's type.
+PARQUET_TYPES = {"id": "int64", "chat_id": "int64", "amount": "float64"}
+
+
+def _write_parquet(path: str, sheet: str, columns: list[str], pages):
     try:
-        df = pd.read_sql_query(
-            "SELECT id, chat_id, datetime, business_date, shift, currency, amount FROM history ORDER BY datetime",
-            conn,
-        )
-    finally:
-        conn.close()
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow).")
+
+    schema = pa.schema([(name, getattr(pa, PARQUET_TYPES.get(name, "string"))()) for name in columns])
+    # One row group per cursor page, every page (and an empty export) with the same schema
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for rows in pages:
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+
+# format -> (file extension, writer(path, sheet, columns, pages))
+EXPORT_FORMATS = {
+    "xlsx": ("xlsx", _write_xlsx),
+    "csv": ("csv.gz", _write_csv_gz),
+    "parquet": ("parquet", _write_parquet),
+}
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "xlsx")  # used by the 📤 Export button
+
+
+# Finished exports are kept here and reused until history matching their filters changes.
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "export_cache"))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_MB", "512")) * 1024 * 1024
+# Files younger than this are never evicted, so an export being uploaded is not deleted under it.
+EXPORT_CACHE_MIN_AGE = 120
 
-    # Ensure a file exists even if empty
-    if df is None or df.empty:
-        df = pd.DataFrame(columns=["id", "chat_id", "datetime", "business_date", "shift", "currency", "amount"])
+_export_locks: dict[str, threading.Lock] = {}
+_export_locks_guard = threading.Lock()
 
-    df.to_excel(OUTPUT_FILE, index=False)
-    print(f"Exported data to {OUTPUT_FILE}")
-    return OUTPUT_FILE
+
+def _export_lock(key: str) -> threading.Lock:
+    with _export_locks_guard:
+        return _export_locks.setdefault(key, threading.Lock())
+
+
+def _tracked(pages, stats: dict, progress=None, total: int = 0):
+    """
+    Pass pages through, recording the row count and the last row's datetime in stats
+    and reporting progress(rows_written, total) after each page.
+    """
+    dt_index = HISTORY_COLUMNS.index("datetime")
+    written = 0
+    for rows in pages:
+        stats["rows"] += len(rows)
+        stats["last_datetime"] = rows[-1][dt_index]
+        yield rows
+        written += len(rows)
+        if progress:
+            progress(written, total)
+
+
+def _append_csv_gz(path: str, pages):
+    # A gzip file may hold several members; readers see one continuous stream
+    with gzip.open(path, "at", encoding="utf-8", newline="", compresslevel=6) as f:
+        writer = csv.writer(f)
+        for rows in pages:
+            writer.writerows(rows)
+
+
+def _evict_export_cache(keep: str):
+    """Delete least recently used exports until the cache fits EXPORT_CACHE_MAX_BYTES."""
+    now = datetime.now().timestamp()
+    entries = []
+    for entry in os.scandir(EXPORT_CACHE_DIR):
+        if entry.name.endswith((".json", ".tmp")) or not entry.is_file():
+            continue
+        st = entry.stat()
+        entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _mtime, size, _path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        if path == keep or now - mtime < EXPORT_CACHE_MIN_AGE:
+            continue
+        key = os.path.basename(path).split(".", 1)[0]
+        for victim in (path, os.path.join(EXPORT_CACHE_DIR, f"{key}.json")):
+            try:
+                os.remove(victim)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def export_history(filters: ExportFilters | None = None, fmt: str = "xlsx", progress=None) -> str:
+    """
+    Path of an export of the history rows matching `filters` in `fmt` (see EXPORT_FORMATS).
+    Exports are cached in EXPORT_CACHE_DIR per (filters, fmt) together with the highest matching
+    history id; a cached file is returned as-is while that mark is unchanged, and a stale CSV is
+    brought up to date by appending only the newer rows. The file belongs to the cache: don't delete it.
+    progress(rows_written, rows_total), if given, is called from this thread as pages are written.
+    """
+    filters = filters or ExportFilters()
+    ext, write = EXPORT_FORMATS[fmt]
+    key = hashlib.sha1(repr((dataclasses.astuple(filters), fmt)).encode()).hexdigest()[:20]
+    path = os.path.join(EXPORT_CACHE_DIR, f"{key}.{ext}")
+    meta_path = os.path.join(EXPORT_CACHE_DIR, f"{key}.json")
+    tmp_path = path + ".tmp"
+    where, params = filters.where()
+
+    flush_write_queue()
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    with _export_lock(key), DB.read() as conn:
+        conn.execute("BEGIN")  # one snapshot for the mark and the rows
+        try:
+            top = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM history WHERE {where}", params).fetchone()[0]
+            rev = _get_meta(conn, HISTORY_REV_KEY, 0)
+            meta = None
+            if os.path.exists(path) and os.path.exists(meta_path):
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta["rev"] != rev or meta["hwm"] > top:
+                    meta = None  # history was rewritten, not just appended to
+
+            if meta and meta["hwm"] == top:
+                os.utime(path)  # most recently used, for eviction
+                print(f"Export cache hit ({filters.describe()}, {fmt})")
+                return path
+
+            appendable = False
+            if meta and fmt == "csv":
+                first_new = conn.execute(f"SELECT MIN(datetime) FROM history WHERE {where} AND id > ?", (*params, meta["hwm"])).fetchone()[0]
+                # New rows must sort after everything already written (ORDER BY datetime, id)
+                appendable = meta["last_datetime"] is None or first_new >= meta["last_datetime"]
+
+            if appendable:
+                where, params = f"{where} AND id > ?", [*params, meta["hwm"]]
+            total = 0
+            if progress:
+                total = conn.execute(f"SELECT COUNT(*) FROM history WHERE {where}", params).fetchone()[0]
+                progress(0, total)
+
+            try:
+                cursor = conn.execute(f"SELECT {HISTORY_SELECT} FROM history WHERE {where} ORDER BY datetime, id", params)
+                if appendable:
+                    stats = {"rows": meta["rows"], "last_datetime": meta["last_datetime"]}
+                    shutil.copyfile(path, tmp_path)
+                    _append_csv_gz(tmp_path, _tracked(_iter_pages(cursor), stats, progress, total))
+                else:
+                    stats = {"rows": 0, "last_datetime": None}
+                    write(tmp_path, "history", HISTORY_COLUMNS, _tracked(_iter_pages(cursor), stats, progress, total))
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            meta = {"filters": dataclasses.asdict(filters), "fmt": fmt, "hwm": top, "rev": rev, **stats}
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        finally:
+            conn.execute("COMMIT")
+
+    print(f"Exported data ({filters.describe()}, {fmt}, {'appended' if appendable else 'built'}) to {path}")
+    _evict_export_cache(keep=path)
+    return path
+
+
+EXPORT_USAGE = "Usage: /exportexcel [YYYY-MM-DD] [YYYY-MM-DD] [shift1|shift2|shift3] [USD|KHR] [xlsx|csv|parquet]"
 
 
 async def export_excel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    path = export_db_to_excel()
-    with open(path, "rb") as f:
-        await update.message.reply_document(
-            document=InputFile(f, filename=os.path.basename(path)),
-            caption="📊 Exported full history as Excel.",
-        )
+    is_admin = update.effective_user.id in ADMINS
+    try:
+        filters, fmt = parse_export_args(context.args or [], update.effective_chat.id, is_admin)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}\n{EXPORT_USAGE}")
+        return
+    await EXPORT_JOBS.submit(update, context, filters, fmt, f"📊 Exported history as {fmt} ({filters.describe()}).")
 
 
-def export_pdf_data(chat_id: int, label: str = "daily", shift: str | None = None, date_str: str | None = None) -> InputFile:
-    date_str = date_str or get_today_str()
-    data = get_totals(chat_id, date_str=date_str, shift=shift)
+# ==============================
+# ----------- Reports ----------
+# ==============================
+# Optional TTF font for PDFs (e.g. a Khmer-capable font so ៛ renders); Helvetica otherwise.
+REPORT_FONT = os.getenv("REPORT_FONT", "")
+# Invoice listings are cut off after this many rows; the summaries still cover every receipt.
+REPORT_MAX_INVOICES = int(os.getenv("REPORT_MAX_INVOICES", "20000"))
+# platypus lays out a table in one piece, so long tables are split into chunks of this many rows.
+REPORT_TABLE_ROWS = 500
+
+# period -> (summary unit, SQL expression mapping a business_date to the unit it falls in)
+REPORT_PERIODS = {
+    "daily": ("Day", "business_date"),
+    "weekly": ("Week of", "date(business_date, '-6 days', 'weekday 1')"),  # the Monday starting that week
+    "monthly": ("Month", "substr(business_date, 1, 7)"),
+}
+REPORT_USAGE = "Usage: /report [daily|weekly|monthly] [from] [to] [shift1|shift2|shift3] [USD|KHR] [invoices] [pdf|xlsx]"
+REPORT_FORMATS = ("pdf", "xlsx")
+
+
+@dataclass(frozen=True)
+class ReportSpec:
+    """A report: which history rows it covers, how the summary is grouped, whether every invoice is listed and the file format."""
+
+    filters: ExportFilters
+    period: str = "daily"
+    invoices: bool = False
+    fmt: str = "pdf"
+
+    def filename(self) -> str:
+        return self.filters.filename(self.fmt).replace("history", f"report_{self.period}", 1)
+
+
+def _period_start(period: str, date_str: str) -> str:
+    day = date.fromisoformat(date_str)
+    if period == "weekly":
+        day -= timedelta(days=day.weekday())
+    elif period == "monthly":
+        day = day.replace(day=1)
+    return day.isoformat()
+
+
+def parse_report_args(args: list[str], current_chat_id: int, is_admin: bool, today: str) -> ReportSpec:
+    """
+    /report arguments -> ReportSpec. Dates, shift, currency and chat scoping work as for exports;
+    without dates the report covers the current day, week or month up to `today`.
+    """
+    period, invoices, fmt, rest = "daily", False, "pdf", []
+    for arg in args:
+        low = arg.lower()
+        if low in REPORT_PERIODS:
+            period = low
+        elif low == "invoices":
+            invoices = True
+        elif low in REPORT_FORMATS:
+            fmt = low
+        elif low in EXPORT_FORMATS:
+            raise ValueError(f"Unknown argument: {arg}")
+        else:
+            rest.append(arg)
+    filters, _fmt = parse_export_args(rest, current_chat_id, is_admin)
+    if not (filters.date_from or filters.date_to):
+        filters = dataclasses.replace(filters, date_from=_period_start(period, today), date_to=today)
+    return ReportSpec(filters=filters, period=period, invoices=invoices, fmt=fmt)
+
+
+@functools.lru_cache(maxsize=None)
+def _report_styles() -> dict:
+    """Fonts, paragraph and table styles shared by every PDF; built once per process."""
+    font, bold = "Helvetica", "Helvetica-Bold"
+    if REPORT_FONT:
+        pdfmetrics.registerFont(TTFont("ReportFont", REPORT_FONT))
+        font = bold = "ReportFont"
+    base = getSampleStyleSheet()
+    return {
+        "font": font,
+        "riel": "៛" if REPORT_FONT else " KHR",  # the base-14 fonts have no ៛ glyph
+        "title": ParagraphStyle("ReportTitle", parent=base["Title"], fontName=bold, fontSize=16, alignment=0),
+        "heading": ParagraphStyle("ReportHeading", parent=base["Heading2"], fontName=bold, spaceBefore=12),
+        "body": ParagraphStyle("ReportBody", parent=base["Normal"], fontName=font, fontSize=10),
+        "table": TableStyle(
+            [
+                ("FONT", (0, 0), (-1, -1), font, 9),
+                ("FONT", (0, 0), (-1, 0), bold, 9),
+                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#dde3ea")),
+                ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f5f7f9")]),
+                ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+                ("ALIGN", (1, 0), (-1, -1), "RIGHT"),
+            ]
+        ),
+    }
+
+
+def _init_report_worker():
+    # Runs once in each REPORT_POOL process so the first report doesn't pay for font/style setup
+    _report_styles()
+
 
+def _pdf_amount(currency: str, minor: int) -> str:
+    return format_amount(currency, minor).replace("៛", _report_styles()["riel"])
+
+
+def _draw_footer(c, doc):
+    c.saveState()
+    c.setFont(_report_styles()["font"], 8)
+    c.drawString(doc.leftMargin, 24, doc.title)
+    c.drawRightString(A4[0] - doc.rightMargin, 24, f"Page {doc.page}")
+    c.restoreState()
+
+
+def _build_pdf(title: str, story: list) -> bytes:
     buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    doc = SimpleDocTemplate(buffer, pagesize=A4, title=title, leftMargin=40, rightMargin=40, topMargin=40, bottomMargin=48)
+    doc.build(story, onFirstPage=_draw_footer, onLaterPages=_draw_footer)
+    return buffer.getvalue()
+
+
+def _report_header(title: str, lines: list[str]) -> list:
+    styles = _report_styles()
+    generated = local_now().strftime("%Y-%m-%d %H:%M:%S")
+    story = [Paragraph(title, styles["title"])]
+    story.extend(Paragraph(line, styles["body"]) for line in [*lines, f"Generated: {generated}"])
+    story.append(Spacer(1, 12))
+    return story
+
+
+def _tables(columns: list[str], rows: list[list]) -> list:
+    """rows as one or more tables of REPORT_TABLE_ROWS rows, each repeating the header on every page."""
+    style = _report_styles()["table"]
+    return [
+        Table([columns, *rows[i : i + REPORT_TABLE_ROWS]], style=style, repeatRows=1, hAlign="LEFT")
+        for i in range(0, max(len(rows), 1), REPORT_TABLE_ROWS)
+    ]
+
+
+def _pivot_currencies(rows, amount=_pdf_amount) -> list[list]:
+    """(key..., currency, total, invoices) rows -> [key..., USD total, USD invoices, KHR total, KHR invoices]."""
+    pivot: dict[tuple, dict] = {}
+    for *key, currency, total, invoices in rows:
+        pivot.setdefault(tuple(key), _empty_totals())[currency] = {"total": total, "invoices": invoices}
+    return [
+        [*key, amount("USD", t["USD"]["total"]), t["USD"]["invoices"], amount("KHR", t["KHR"]["total"]), t["KHR"]["invoices"]]
+        for key, t in pivot.items()
+    ]
+
+
+def _xlsx_amount(currency: str, minor: int) -> float:
+    return minor / MINOR_UNITS[currency]
+
+
+def render_totals_pdf(label: str, date_str: str, data: dict) -> bytes:
+    """One shift's (or day's) USD/KHR totals as a single-page PDF."""
+    story = _report_header(f"Invoice Summary ({label.title()})", [f"Business Date: {date_str}"])
+    rows = [[cur, _pdf_amount(cur, data[cur]["total"]), data[cur]["invoices"]] for cur in ("USD", "KHR")]
+    combined = data.get("combined")
+    if combined:
+        rows += [
+            [f"Combined in {cur} (1$ = {combined['rate']:,.0f})", _pdf_amount(cur, combined[cur]), ""]
+            for cur in ("USD", "KHR")
+        ]
+    story.extend(_tables(["Currency", "Total", "Invoices"], rows))
+    return _build_pdf(f"Invoice Summary ({label.title()}) {date_str}", story)
+
+
+def _whole_months(date_from: str | None, date_to: str | None) -> tuple[str | None, str | None]:
+    """First and last YYYY-MM lying wholly inside an inclusive date range (None: unbounded)."""
+    first = last = None
+    if date_from:
+        day = date.fromisoformat(date_from)
+        if day.day != 1:
+            day = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+        first = day.isoformat()[:7]
+    if date_to:
+        day = date.fromisoformat(date_to) + timedelta(days=1)
+        last = (day.replace(day=1) - timedelta(days=1)).isoformat()[:7]
+    return first, last
+
+
+def _report_summary(conn: sqlite3.Connection, spec: ReportSpec) -> list[tuple]:
+    """(period, currency, total, invoices) per day/week/month, read from the rollup tables."""
+    filters = spec.filters
+    where, params = filters.where()
+    if spec.period != "monthly" or filters.shift:
+        return conn.execute(
+            f"""SELECT {REPORT_PERIODS[spec.period][1]} AS period, currency, SUM(total), SUM(invoices)
+                FROM daily_rollups WHERE {where} GROUP BY period, currency ORDER BY period""",
+            params,
+        ).fetchall()
+    # Months wholly in range come from monthly_rollups, the partial ones at either end from daily_rollups
+    first, last = _whole_months(filters.date_from, filters.date_to)
+    month_where, month_params = _scope_sql(filters.chat_id, first, last, "month")
+    if filters.currency:
+        month_where += " AND currency = ?"
+        month_params.append(filters.currency)
+    whole, whole_params = _scope_sql(None, first, last, "substr(business_date, 1, 7)")
+    return conn.execute(
+        f"""SELECT period, currency, SUM(total), SUM(invoices) FROM (
+                SELECT month AS period, currency, total, invoices FROM monthly_rollups WHERE {month_where}
+                UNION ALL
+                SELECT substr(business_date, 1, 7), currency, total, invoices FROM daily_rollups
+                WHERE {where} AND NOT ({whole})
+            ) GROUP BY period, currency ORDER BY period""",
+        [*month_params, *params, *whole_params],
+    ).fetchall()
+
+
+def render_report(spec: ReportSpec) -> bytes:
+    """
+    Multi-page report over spec.filters (PDF, or an xlsx workbook): a summary per day/week/month
+    and a per-shift breakdown per business date, both read from the rollup tables, and optionally
+    every invoice from history. Reads through its own connection, so it runs unchanged in a
+    REPORT_POOL process.
+    """
+    styles = _report_styles()
+    where, params = spec.filters.where()
+    unit, _period = REPORT_PERIODS[spec.period]
+    chat_column = ["chat_id"] if spec.filters.chat_id is None else []
+
+    with DB.read() as conn:
+        conn.execute("BEGIN")  # every section from one snapshot
+        try:
+            summary = _report_summary(conn, spec)
+            shifts = conn.execute(
+                f"""SELECT business_date, shift, currency, SUM(total), SUM(invoices) FROM daily_rollups
+                    WHERE {where} GROUP BY business_date, shift, currency ORDER BY business_date, shift""",
+                params,
+            ).fetchall()
+            listing = []
+            if spec.invoices:
+                listing = conn.execute(
+                    f"""SELECT {', '.join([*chat_column, 'datetime', 'shift', 'currency', 'amount'])} FROM history
+                        WHERE {where} ORDER BY datetime, id LIMIT ?""",
+                    [*params, REPORT_MAX_INVOICES + 1],
+                ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+
+    grand = {}
+    for _period, currency, total, invoices in summary:
+        t, n = grand.get(currency, (0, 0))
+        grand[currency] = (t + total, n + invoices)
+    totals_rows = [("Total", cur, t, n) for cur, (t, n) in grand.items()]
+    currency_columns = ["USD", "USD invoices", "KHR", "KHR invoices"]
+    truncated = len(listing) > REPORT_MAX_INVOICES
+    listing = listing[:REPORT_MAX_INVOICES]
+
+    if spec.fmt == "xlsx":
+        wb = Workbook(write_only=True)
+        sheets = [
+            ("Summary", [unit, *currency_columns], _pivot_currencies([*summary, *totals_rows], _xlsx_amount)),
+            ("Shifts", ["Business date", "Shift", *currency_columns], _pivot_currencies(shifts, _xlsx_amount)),
+        ]
+        if spec.invoices:
+            rows = [[*row[:-1], _xlsx_amount(row[-2], row[-1])] for row in listing]
+            sheets.append(("Invoices", [*chat_column, "Date/time", "Shift", "Currency", "Amount"], rows))
+        for name, columns, rows in sheets:
+            ws = wb.create_sheet(name)
+            ws.append(columns)
+            for row in rows:
+                ws.append(row)
+        buffer = io.BytesIO()
+        wb.save(buffer)
+        return buffer.getvalue()
+
+    title = f"{spec.period.title()} Report"
+    story = _report_header(title, [f"Scope: {spec.filters.describe()}"])
+    if not summary:
+        story.append(Paragraph("No receipts in this range.", styles["body"]))
+        return _build_pdf(title, story)
+
+    story.append(Paragraph(f"{spec.period.title()} summary", styles["heading"]))
+    story.extend(_tables([unit, *currency_columns], _pivot_currencies([*summary, *totals_rows])))
+
+    story.append(Paragraph("Per-shift breakdown", styles["heading"]))
+    story.extend(_tables(["Business date", "Shift", *currency_columns], _pivot_currencies(shifts)))
+
+    if spec.invoices:
+        story.append(PageBreak())
+        story.append(Paragraph("Invoices", styles["heading"]))
+        rows = [[*row[:-2], row[-2], _pdf_amount(row[-2], row[-1])] for row in listing]
+        story.extend(_tables([*chat_column, "Date/time", "Shift", "Currency", "Amount"], rows))
+        if truncated:
+            story.append(Paragraph(f"Listing cut off after {REPORT_MAX_INVOICES:,} invoices.", styles["body"]))
+    return _build_pdf(title, story)
+
+
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    is_admin = update.effective_user.id in ADMINS
+    _shift, biz_date_now = get_shift_and_business_date(chat_id=update.effective_chat.id)
+    try:
+        spec = parse_report_args(context.args or [], update.effective_chat.id, is_admin, biz_date_now)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}\n{REPORT_USAGE}")
+        return
+    status = await update.message.reply_text(f"⏳ Building {spec.period} report ({spec.filters.describe()})…")
+    # Rendered in the background so other updates keep being handled meanwhile
+    context.application.create_task(_send_report(context, update.effective_chat.id, status.message_id, spec))
+
+
+async def _send_report(context: ContextTypes.DEFAULT_TYPE, chat_id: int, status_message_id: int, spec: ReportSpec):
+    try:
+        report = await render_report_async(spec)
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=InputFile(io.BytesIO(report), filename=spec.filename()),
+            caption=f"🧾 {spec.period.title()} report ({spec.filters.describe()}).",
+        )
+    except Exception as e:
+        await context.bot.edit_message_text(f"❌ Report failed: {e}", chat_id=chat_id, message_id=status_message_id)
+        return
+    try:
+        await context.bot.delete_message(chat_id=chat_id, message_id=status_message_id)
+    except Exception as e:
+        print(f"Report status delete failed: {e}")
+
+
+# ==============================
+# --------- Executors ----------
+# ==============================
+# Blocking sqlite3 / openpyxl / reportlab work never runs on the event loop:
+# writes go through a single DB thread (so they queue instead of contending for the
+# writer lock), short reads through a reader pool, exports through a worker pool and
+# PDF rendering (CPU-bound, holds the GIL) through a pool of processes.
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+
+DB_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+DB_READERS = ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix="db-reader")
+EXPORT_POOL = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+# spawn: workers start clean instead of inheriting this process's threads and SQLite handles
+REPORT_POOL = ProcessPoolExecutor(
+    max_workers=REPORT_WORKERS,
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=_init_report_worker,
+)
+
+
+async def run_in(executor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def ingest_amounts_async(chat_id: int, amounts: list[tuple[float, str]]) -> dict:
+    if WRITE_QUEUE:
+        # Served from memory; the DB thread is only needed on a chat's first receipt of a shift
+        return await run_in(DB_READERS, WRITE_QUEUE.enqueue, chat_id, amounts)
+    return await run_in(DB_WRITER, ingest_amounts, chat_id, amounts)
+
+
+async def get_totals_async(chat_id: int, date_str: str | None = None, shift: str | None = None):
+    return await run_in(DB_READERS, get_totals, chat_id, date_str=date_str, shift=shift)
+
+
+async def get_old_totals_async(chat_id: int, date_str: str | None = None):
+    return await run_in(DB_READERS, get_old_totals, chat_id, date_str=date_str)
+
+
+async def get_report_totals_async(chat_id: int, date_str: str, shift: str | None = None):
+    return await run_in(DB_READERS, get_report_totals, chat_id, date_str, shift)
+
+
+async def move_to_old_async(chat_id: int, shift: str, date_str: str):
+    return await run_in(DB_WRITER, move_to_old, chat_id, shift, date_str)
+
+
+async def reset_totals_async(chat_id: int, date_str: str):
+    return await run_in(DB_WRITER, reset_totals, chat_id, date_str)
+
 
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(72, height - 60, f"Invoice Summary ({label.title()})")
-    c.setFont("Helvetica", 11)
-    c.drawString(72, height - 80, f"Business Date: {date_str}")
-    c.drawString(72, height - 96, f"Generated: {now}")
+async def render_report_async(spec: ReportSpec) -> bytes:
+    # The worker process reads the database itself, so pending write-behind rows go in first
+    await run_in(DB_READERS, flush_write_queue)
+    return await run_in(REPORT_POOL, render_report, spec)
 
-    y = height - 140
-    c.setFont("Helvetica", 12)
-    c.drawString(72, y, f"USD: {data['USD']['total']:.2f}$ ({data['USD']['invoices']} invoices)")
-    c.drawString(72, y - 20, f"KHR: {data['KHR']['total']:,.0f}៛ ({data['KHR']['invoices']} invoices)")
 
-    c.showPage()
-    c.save()
-    buffer.seek(0)
-    return InputFile(buffer, filename=f"totals_{label}_{date_str}.pdf")
+def shutdown_executors():
+    for executor in (REPORT_POOL, EXPORT_POOL, DB_READERS, DB_WRITER):
+        executor.shutdown(wait=True)
+
+
+# ==============================
+# -------- Export Jobs ---------
+# ==============================
+# Seconds between progress edits of an export's status message (Telegram rate-limits edits).
+EXPORT_PROGRESS_INTERVAL = float(os.getenv("EXPORT_PROGRESS_INTERVAL", "3"))
+
+
+@dataclass
+class ExportRequest:
+    """Where a finished export goes: the requester's chat, their status message and the upload caption."""
+
+    chat_id: int
+    caption: str
+    reply_markup: ReplyKeyboardMarkup | None = None
+    status_message_id: int | None = None  # set once the status message has been sent
+    finished: bool = False
+    failure: str | None = None
+
+
+@dataclass
+class ExportJob:
+    filters: ExportFilters
+    fmt: str
+    requests: list[ExportRequest]
+    state: str = "queued"
+    done_rows: int = 0
+    total_rows: int = 0
+
+    def progress(self, done_rows: int, total_rows: int):
+        # Called from the export worker thread; plain attribute writes are read by the status ticker
+        self.done_rows, self.total_rows = done_rows, total_rows
+
+    def status_text(self) -> str:
+        head = f"📤 {self.fmt} export ({self.filters.describe()})"
+        if self.state == "queued":
+            return f"{head}\n⏳ Queued…"
+        if not self.total_rows:
+            return f"{head}\n⚙️ Preparing…"
+        pct = self.done_rows * 100 // self.total_rows
+        return f"{head}\n⚙️ {pct}% ({self.done_rows:,}/{self.total_rows:,} rows)"
+
+
+class ExportJobScheduler:
+    """
+    Runs exports in the background: a request gets an immediate status message, identical
+    requests in flight share one job, at most EXPORT_WORKERS jobs run at once on EXPORT_POOL,
+    status messages are edited with progress and every requester receives the file when done.
+    """
+
+    def __init__(self, max_running: int = EXPORT_WORKERS):
+        self._jobs: dict[tuple, ExportJob] = {}
+        self._slots = asyncio.Semaphore(max_running)
+
+    async def submit(self, update: Update, context: ContextTypes.DEFAULT_TYPE, filters: ExportFilters, fmt: str, caption: str, reply_markup=None):
+        key = (filters, fmt)
+        # Job and request are registered before any await, so identical requests arriving
+        # meanwhile join this job and a job finishing meanwhile still delivers to this one
+        req = ExportRequest(update.effective_chat.id, caption, reply_markup)
+        job = self._jobs.get(key)
+        if job is not None:
+            job.requests.append(req)
+            status = await update.message.reply_text(f"{job.status_text()}\n👥 Same export already in progress — you'll get the file too.")
+        else:
+            job = ExportJob(filters=filters, fmt=fmt, requests=[req])
+            self._jobs[key] = job
+            context.application.create_task(self._run(key, job, context))
+            status = await update.message.reply_text(job.status_text())
+        req.status_message_id = status.message_id
+        if req.finished:
+            await self._close_status(context.bot, req)
+
+    async def _close_status(self, bot, req: ExportRequest):
+        """Delete a finished request's status message, or show its failure there."""
+        req.finished = True
+        if req.status_message_id is None:
+            return  # submit() closes it once the status message is sent
+        try:
+            if req.failure:
+                await bot.edit_message_text(req.failure, chat_id=req.chat_id, message_id=req.status_message_id)
+            else:
+                await bot.delete_message(chat_id=req.chat_id, message_id=req.status_message_id)
+        except Exception as e:
+            print(f"Export status update failed: {e}")
+
+    async def _edit_status(self, bot, job: ExportJob, text: str):
+        for req in list(job.requests):
+            if req.status_message_id is None:
+                continue
+            try:
+                await bot.edit_message_text(text, chat_id=req.chat_id, message_id=req.status_message_id)
+            except Exception as e:
+                # "message is not modified", deleted status message, ... — not critical
+                print(f"Export status edit failed: {e}")
+
+    async def _run(self, key: tuple, job: ExportJob, context: ContextTypes.DEFAULT_TYPE):
+        bot = context.bot
+        try:
+            async with self._slots:
+                job.state = "running"
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(EXPORT_POOL, functools.partial(export_history, job.filters, job.fmt, progress=job.progress))
+                shown = None
+                while True:
+                    done, _ = await asyncio.wait({future}, timeout=EXPORT_PROGRESS_INTERVAL)
+                    if done:
+                        break
+                    text = job.status_text()
+                    if text != shown:
+                        await self._edit_status(bot, job, text)
+                        shown = text
+                path = future.result()
+        except Exception as e:
+            self._jobs.pop(key, None)
+            for req in job.requests:
+                req.failure = f"❌ Export failed: {e}"
+                await self._close_status(bot, req)
+            return
+
+        # Later identical requests start a new job, which is served from the export cache
+        self._jobs.pop(key, None)
+        filename = job.filters.filename(EXPORT_FORMATS[job.fmt][0])
+        for req in job.requests:
+            try:
+                with open(path, "rb") as f:
+                    sent_msg = await bot.send_document(
+                        chat_id=req.chat_id,
+                        document=InputFile(f, filename=filename),
+                        caption=req.caption,
+                        reply_markup=req.reply_markup,
+                    )
+            except Exception as e:
+                print(f"Export upload to {req.chat_id} failed: {e}")
+                req.failure = f"❌ Upload failed: {e}"
+                await self._close_status(bot, req)
+                continue
+            await self._close_status(bot, req)
+            if req.reply_markup is not None:
+                context.application.create_task(auto_close_keyboard(context, req.chat_id, sent_msg.message_id))
+
+
+EXPORT_JOBS = ExportJobScheduler()
+
+
+# ==============================
+# ------ Shift PDF Cache -------
+# ==============================
+# Rendered shift PDFs kept in memory (a few KB each).
+SHIFT_PDF_CACHE_SIZE = int(os.getenv("SHIFT_PDF_CACHE_SIZE", "1024"))
+# How often the scheduler checks whether a shift has ended.
+SHIFT_TICK_SECONDS = int(os.getenv("SHIFT_TICK_SECONDS", "30"))
+# Move every chat's totals to Old Data when its shift ends (AUTO_ROLLOVER=0 leaves it to "🆕 New Data").
+AUTO_ROLLOVER = os.getenv("AUTO_ROLLOVER", "1") == "1"
+
+
+class ShiftPdfCache:
+    """
+    Shift PDFs keyed by (chat_id, business_date, shift), each stored with the totals it shows
+    (active plus rolled over, see get_report_totals). A lookup re-reads the totals
+    (in-memory hits in TOTALS_CACHE and OLD_TOTALS_CACHE) and serves the stored PDF
+    only if they still match, so late receipts, resets and recalcs re-render it automatically.
+    Concurrent taps for the same PDF share one render. Only used from the event loop.
+    """
+
+    def __init__(self, maxsize: int = SHIFT_PDF_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()  # key -> (totals, pdf bytes)
+        self._rendering: dict[tuple, tuple[dict, asyncio.Future]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, chat_id: int, shift: str, date_str: str) -> bytes:
+        key = (chat_id, date_str, shift)
+        data = await get_report_totals_async(chat_id, date_str, shift)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == data:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+        pending = self._rendering.get(key)
+        if pending is not None and pending[0] == data:
+            return await asyncio.shield(pending[1])
+        future = asyncio.ensure_future(run_in(REPORT_POOL, render_totals_pdf, shift, date_str, data))
+        self._rendering[key] = (data, future)
+        try:
+            pdf = await asyncio.shield(future)
+        finally:
+            if self._rendering.get(key, (None, None))[1] is future:
+                del self._rendering[key]
+        self._entries[key] = (data, pdf)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return pdf
+
+    async def prerender(self, shift: str, date_str: str, chat_id: int | None = None) -> int:
+        """
+        Render the shift's PDF for every chat with receipts in it; returns how many chats.
+        chat_id limits it to that chat; None means the chats on the default schedule.
+        """
+        chat_ids = await run_in(DB_READERS, chats_with_history, date_str, shift)
+        if chat_id is None:
+            chat_ids = [c for c in chat_ids if c not in CHAT_SHIFT_SCHEDULES]
+        else:
+            chat_ids = [c for c in chat_ids if c == chat_id]
+        results = await asyncio.gather(*(self.get(chat_id, shift, date_str) for chat_id in chat_ids), return_exceptions=True)
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                print(f"Pre-rendering {shift} {date_str} for chat {chat_id} failed: {result}")
+        return len(chat_ids)
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups * 100 if lookups else 0.0
+        return f"{len(self._entries)}/{self.maxsize} PDFs, {self.hits} hits, {self.misses} misses ({ratio:.1f}% hit)"
+
+
+SHIFT_PDFS = ShiftPdfCache()
+
+
+def chats_with_history(date_str: str, shift: str) -> list[int]:
+    flush_write_queue()
+    with DB.read() as conn:
+        rows = conn.execute(
+            "SELECT DISTINCT chat_id FROM history WHERE business_date = ? AND shift = ?",
+            (date_str, shift),
+        ).fetchall()
+    return [chat_id for (chat_id,) in rows]
+
+
+def latest_shift_date(shift: str, shift_now: str, biz_date_now: str) -> str:
+    """Business date of the latest occurrence of `shift`: today's, unless it hasn't started yet today."""
+    if SHIFT_ORDER.index(shift) > SHIFT_ORDER.index(shift_now):
+        return (date.fromisoformat(biz_date_now) - timedelta(days=1)).isoformat()
+    return biz_date_now
+
+
+async def post_rollover_summaries(bot, moved: list[tuple]):
+    """Tell each chat which of its shifts the automatic rollover closed, with their totals."""
+    closed: dict[tuple, dict] = {}
+    for chat_id, date_str, shift, currency, total, invoices in moved:
+        closed.setdefault((chat_id, date_str, shift), _empty_totals())[currency] = {"total": total, "invoices": invoices}
+    for (chat_id, date_str, shift), totals in sorted(closed.items()):
+        try:
+            await bot.send_message(chat_id, totals_text(totals, f"🔁 {shift.title()} ({date_str}) closed and moved to Old Data"))
+        except Exception as e:
+            print(f"Rollover summary to chat {chat_id} failed: {e}")
+
+
+async def shift_boundary_tick(context: ContextTypes.DEFAULT_TYPE):
+    """
+    JobQueue job: roll ended shifts over to Old Data (see roll_over_ended_shifts), then, when a
+    schedule's current shift changes, pre-render the PDFs of the shift that just ended.
+    """
+    if AUTO_ROLLOVER:
+        moved = await run_in(DB_WRITER, roll_over_ended_shifts)
+        if moved:
+            print(f"Rolled over {len({row[:3] for row in moved})} chat shifts to Old Data")
+            await post_rollover_summaries(context.bot, moved)
+
+    state = context.job.data
+    now_dt = local_now()
+    # None stands for every chat on the default schedule
+    for chat_id, schedule in {None: SHIFT_SCHEDULE, **CHAT_SHIFT_SCHEDULES}.items():
+        now = schedule.resolve(now_dt)
+        ended, state[chat_id] = state.get(chat_id), now
+        if ended is None or ended == now:
+            continue
+        shift, date_str = ended
+        count = await SHIFT_PDFS.prerender(shift, date_str, chat_id)
+        scope = "default schedule" if chat_id is None else f"chat {chat_id}"
+        print(f"Shift {shift} ({date_str}, {scope}) ended: pre-rendered PDFs for {count} chats")
 
 
 # ==============================
@@ -402,32 +2309,124 @@ async def auto_close_keyboard(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
 # ==============================
 # ----- Currency Parser --------
 # ==============================
-def extract_currency_amounts(text: str):
-    text = text.replace(",", "")
-    pattern = r"""
-        (?:
-            (?P<symbol_before>[$៛])\s*(?P<amount1>[-+]?\d*\.?\d+)
-            |
-            (?P<amount2>[-+]?\d*\.?\d+)\s*(?P<code_after>USD|KHR)
-            |
-            (?P<amount3>[-+]?\d*\.?\d+)\s*(?P<symbol_after>[$៛])
-        )
+# Messages are split into tokens by one compiled master pattern (each character is consumed
+# once, so parsing stays linear), then amounts are read off the token stream using the tables
+# below: NUMBER [multiplier] currency, or a $/៛ symbol followed by NUMBER.
+DIGITS = "0-9០-៩"  # ASCII and Khmer numerals
+KHMER_DIGITS = str.maketrans("០១២៣៤៥៦៧៨៩", "0123456789")
+
+# Marker -> currency. Latin words are whole words (case-insensitive); Khmer ones match anywhere.
+CURRENCY_MARKERS = {
+    "$": "USD",
+    "៛": "KHR",
+    "usd": "USD",
+    "khr": "KHR",
+    "dollar": "USD",
+    "dollars": "USD",
+    "riel": "KHR",
+    "riels": "KHR",
+    "ដុល្លារ": "USD",
+    "ដុល្លា": "USD",
+    "រៀល": "KHR",
+}
+# Currency markers that may also come before the number ("$5", "៛5000")
+PREFIX_MARKERS = {"$", "៛"}
+# Multiplier -> factor. k/m must be attached to the number ("20k"); Khmer words may follow a space.
+MULTIPLIERS = {
+    "k": 1_000,
+    "m": 1_000_000,
+    "ពាន់": 1_000,
+    "ម៉ឺន": 10_000,
+    "សែន": 100_000,
+    "លាន": 1_000_000,
+}
+
+_KHMER_WORDS = sorted((w for w in [*CURRENCY_MARKERS, *MULTIPLIERS] if not w.isascii()), key=len, reverse=True)
+# (token kind, pattern), tried in order at each position
+AMOUNT_TOKENS = [
+    (
+        # Dot thousands ("10.000,50", "1.000.000"), comma-separated digits ending in 3+ digits
+        # ("10,000.50", and "1,2345" read as 12345 like the old strip-the-commas parser), a decimal
+        # comma ("12,50") or plain digits ("10000", ".5"). Never starts right after a digit, '.'
+        # or ',' so a number is never read as a shorter one.
+        "NUMBER",
+        rf"(?<![{DIGITS}.,])[-+]?(?:[{DIGITS}]{{1,3}}(?:(?:\.[{DIGITS}]{{3}}){{2,}}(?:,[{DIGITS}]{{1,2}})?|\.[{DIGITS}]{{3}},[{DIGITS}]{{1,2}})(?![{DIGITS}.,])"
+        rf"|[{DIGITS}]+(?:,[{DIGITS}]+)*,[{DIGITS}]{{3,}}(?:\.[{DIGITS}]+)?(?![{DIGITS},])"
+        rf"|[{DIGITS}]+,[{DIGITS}]{{1,2}}(?![{DIGITS},])|[{DIGITS}]*\.?[{DIGITS}]+)"
+        r"(?:[km](?![a-z]))?",
+    ),
+    ("SPACE", r"\s+"),
+    ("SYMBOL", r"[$៛]"),
+    ("KHMER", "|".join(_KHMER_WORDS)),
+    ("WORD", r"[a-z]+"),
+    ("OTHER", r"."),
+]
+AMOUNT_TOKEN_RE = re.compile("|".join(f"(?P<{kind}>{pattern})" for kind, pattern in AMOUNT_TOKENS), re.IGNORECASE | re.DOTALL)
+# Cheap pre-filter: a message without any currency marker can't contain an amount
+CURRENCY_HINT_RE = re.compile("|".join(re.escape(marker) for marker in CURRENCY_MARKERS), re.IGNORECASE)
+
+
+def _parse_number(token: str) -> float:
+    token = token.translate(KHMER_DIGITS)
+    factor = MULTIPLIERS.get(token[-1].lower(), 1)
+    if factor != 1:
+        token = token[:-1]
+    if token.count(".") > 1 or -1 < token.rfind(".") < token.rfind(","):
+        # Dot thousands, optionally with a decimal comma: "10.000,50", "1.000.000"
+        token = token.replace(".", "").replace(",", ".")
+    elif "," in token:
+        whole, _, frac = token.rpartition(",")
+        # 1-2 digits after the last comma: decimal comma; otherwise thousands separators
+        token = f"{whole}.{frac}" if len(frac) < 3 else token.replace(",", "")
+    if factor == 1:
+        return float(token)
+    return float(Decimal(token) * factor)  # "1.1k" is exactly 1100
+
+
+def _amount_tokens(text: str) -> list[tuple[str, str]]:
+    """(kind, text) tokens, whitespace dropped; words carry their lower-cased text."""
+    tokens = []
+    for m in AMOUNT_TOKEN_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == "SPACE":
+            continue
+        value = m.group()
+        tokens.append((kind, value.lower() if kind == "WORD" else value))
+    return tokens
+
+
+def extract_currency_amounts(text: str) -> list[tuple[float, str]]:
+    """
+    All (amount, currency) pairs in a message, in order: "$5", "5$", "10,000៛", "25 usd",
+    "១៥០០០៛", "20k riel", "5 dollars", "12,50$", "២ម៉ឺនរៀល".
     """
-    matches = re.finditer(pattern, text, re.IGNORECASE | re.VERBOSE)
+    if not CURRENCY_HINT_RE.search(text):
+        return []
+    tokens = _amount_tokens(text)
     results: list[tuple[float, str]] = []
-    for m in matches:
-        amount = None
-        currency = None
-        if m.group("symbol_before") and m.group("amount1"):
-            amount = float(m.group("amount1"))
-            currency = "USD" if m.group("symbol_before") == "$" else "KHR"
-        elif m.group("amount2") and m.group("code_after"):
-            amount = float(m.group("amount2"))
-            currency = m.group("code_after").upper()
-        elif m.group("amount3") and m.group("symbol_after"):
-            amount = float(m.group("amount3"))
-            currency = "USD" if m.group("symbol_after") == "$" else "KHR"
-        if amount is not None and currency is not None:
+    i, n = 0, len(tokens)
+    while i < n:
+        kind, value = tokens[i]
+        prefix = None
+        if kind == "SYMBOL" and i + 1 < n and tokens[i + 1][0] == "NUMBER":
+            prefix = CURRENCY_MARKERS[value]
+            i += 1
+            kind, value = tokens[i]
+        if kind != "NUMBER":
+            i += 1
+            continue
+        amount = _parse_number(value)
+        i += 1
+        if i < n and tokens[i][0] == "KHMER" and tokens[i][1] in MULTIPLIERS:
+            amount *= MULTIPLIERS[tokens[i][1]]
+            i += 1
+        currency = CURRENCY_MARKERS.get(tokens[i][1]) if i < n and tokens[i][0] != "NUMBER" else None
+        if currency and prefix and tokens[i][0] == "SYMBOL":
+            currency = None  # after "$5" a symbol starts the next amount ("$5 $10")
+        if currency:
+            i += 1  # "$5 USD" is one amount
+        currency = prefix or currency
+        if currency:
             results.append((amount, currency))
     return results
 
@@ -435,15 +2434,25 @@ def extract_currency_amounts(text: str):
 # ==============================
 # ------- Message Flow ---------
 # ==============================
-async def send_totals(update: Update, totals: dict, label: str, is_admin: bool, context: ContextTypes.DEFAULT_TYPE):
+def totals_text(totals: dict, label: str) -> str:
     lines = [label]
     if totals["USD"]["invoices"]:
-        lines.append(f"🇺🇸 USD: {totals['USD']['total']:.2f}$ ({totals['USD']['invoices']} invoices)")
+        lines.append(f"🇺🇸 USD: {format_amount('USD', totals['USD']['total'])} ({totals['USD']['invoices']} invoices)")
     if totals["KHR"]["invoices"]:
-        lines.append(f"🇰🇭 KHR: {totals['KHR']['total']:,.0f}៛ ({totals['KHR']['invoices']} invoices)")
+        lines.append(f"🇰🇭 KHR: {format_amount('KHR', totals['KHR']['total'])} ({totals['KHR']['invoices']} invoices)")
     if len(lines) == 1:
         lines.append("💤 No data yet.")
-    sent_msg = await update.message.reply_text("\n".join(lines), reply_markup=reply_menu(is_admin))
+    elif totals.get("combined"):
+        combined = totals["combined"]
+        lines.append(
+            f"💱 Combined: {format_amount('USD', combined['USD'])} ≈ {format_amount('KHR', combined['KHR'])} "
+            f"(1$ = {combined['rate']:,.0f}៛)"
+        )
+    return "\n".join(lines)
+
+
+async def send_totals(update: Update, totals: dict, label: str, is_admin: bool, context: ContextTypes.DEFAULT_TYPE):
+    sent_msg = await update.message.reply_text(totals_text(totals, label), reply_markup=reply_menu(is_admin))
     context.application.create_task(auto_close_keyboard(context, update.effective_chat.id, sent_msg.message_id))
 
 
@@ -454,47 +2463,59 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
 
     # Determine current shift and business date
-    shift_now, biz_date_now = get_shift_and_business_date()
+    shift_now, biz_date_now = get_shift_and_business_date(chat_id=chat_id)
 
     if text == "🆕 New Data":
         # Move only the current shift for the current business date
-        move_to_old(chat_id, shift_now, biz_date_now)
-        totals = get_old_totals(chat_id, date_str=biz_date_now)
+        await move_to_old_async(chat_id, shift_now, biz_date_now)
+        totals = await get_old_totals_async(chat_id, date_str=biz_date_now)
         await send_totals(update, totals, f"✅ {shift_now.title()} moved to Old Data ({biz_date_now})", is_admin, context)
 
     elif text == "📦 Old Data":
-        totals = get_old_totals(chat_id, date_str=biz_date_now)
+        totals = await get_old_totals_async(chat_id, date_str=biz_date_now)
         await send_totals(update, totals, f"📦 Old Totals ({biz_date_now})", is_admin, context)
 
     elif text == "📊 Total":
-        totals = get_totals(chat_id, date_str=biz_date_now, shift=shift_now)
+        totals = await get_totals_async(chat_id, date_str=biz_date_now, shift=shift_now)
         await send_totals(update, totals, f"📊 Total for {shift_now.title()} ({biz_date_now})", is_admin, context)
 
     elif text == "📊 Total All":
-        totals = get_totals(chat_id, date_str=biz_date_now)
+        # Includes shifts already rolled over to Old Data
+        totals = await get_report_totals_async(chat_id, biz_date_now)
         await send_totals(update, totals, f"📊 Total for All Shifts ({biz_date_now})", is_admin, context)
 
     elif text == "🔄 Reset":
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE totals SET total = 0, invoices = 0 WHERE chat_id = ? AND date = ?", (chat_id, biz_date_now))
-        conn.commit()
-        conn.close()
+        await reset_totals_async(chat_id, biz_date_now)
         sent_msg = await update.message.reply_text("🔄 Reset done for today’s business date.", reply_markup=reply_menu(is_admin))
         context.application.create_task(auto_close_keyboard(context, chat_id, sent_msg.message_id))
 
     elif text in ["🕐 Shift 1", "🕑 Shift 2", "🌙 Shift 3"]:
         shift_map = {"🕐 Shift 1": "shift1", "🕑 Shift 2": "shift2", "🌙 Shift 3": "shift3"}
         sh = shift_map[text]
-        file = export_pdf_data(chat_id, label=sh, shift=sh, date_str=biz_date_now)
-        sent_msg = await update.message.reply_document(file, caption=f"{text} export complete ({biz_date_now}).", reply_markup=reply_menu(is_admin))
+        # Right after a shift change the button means the shift that just ended
+        date_str = latest_shift_date(sh, shift_now, biz_date_now)
+        pdf = await SHIFT_PDFS.get(chat_id, sh, date_str)
+        file = InputFile(io.BytesIO(pdf), filename=f"totals_{sh}_{date_str}.pdf")
+        sent_msg = await update.message.reply_document(file, caption=f"{text} export complete ({date_str}).", reply_markup=reply_menu(is_admin))
         context.application.create_task(auto_close_keyboard(context, chat_id, sent_msg.message_id))
 
-    elif text == "📤 Export":
-        path = export_db_to_excel()
-        with open(path, "rb") as f:
-            sent_msg = await update.message.reply_document(f, caption="📤 Full history exported.", reply_markup=reply_menu(is_admin))
-        context.application.create_task(auto_close_keyboard(context, chat_id, sent_msg.message_id))
+    elif text == "📤 Export" or text.startswith("📤 Export "):
+        # This chat's current business day unless arguments follow ("📤 Export csv 2026-10-01 2026-10-18")
+        try:
+            filters, fmt = parse_export_args(text.split()[2:], chat_id, is_admin, EXPORT_FORMAT)
+        except ValueError as e:
+            await update.message.reply_text(f"⚠️ {e}\n{EXPORT_USAGE}")
+            return
+        if not (filters.date_from or filters.date_to):
+            filters = dataclasses.replace(filters, date_from=biz_date_now, date_to=biz_date_now)
+        await EXPORT_JOBS.submit(
+            update,
+            context,
+            filters,
+            fmt,
+            f"📤 History exported as {fmt} ({filters.describe()}).\nOther dates: /exportexcel FROM TO",
+            reply_markup=reply_menu(is_admin),
+        )
 
     else:
         amounts = extract_currency_amounts(text)
@@ -502,20 +2523,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Ignore unrelated text
             return
         response_lines = []
-        for amount, currency in amounts:
-            update_total(chat_id, currency, amount)
-        # After all inserts, show updated shift totals
-        totals = get_totals(chat_id, date_str=biz_date_now, shift=shift_now)
+        # One transaction for every amount; returns the updated shift totals
+        totals = await ingest_amounts_async(chat_id, amounts)
         # Khmer confirmations
         for amount, currency in amounts:
             if currency == "USD":
-                response_lines.append(f"✅ បានទទួលដុល្លា: {amount:.2f}$")
+                response_lines.append(f"✅ បានទទួលដុល្លា: {format_amount(currency, to_minor(amount, currency))}")
             else:
-                response_lines.append(f"✅ បានទទួលប្រាក់ខ្មែរ: {amount:,.0f}៛")
+                response_lines.append(f"✅ បានទទួលប្រាក់ខ្មែរ: {format_amount(currency, to_minor(amount, currency))}")
         response_lines.append(
             f"សរុប"
-            f"🇺🇸 USD: {totals['USD']['total']:.2f}$ ({totals['USD']['invoices']} invoices) | "
-            f"🇰🇭 KHR: {totals['KHR']['total']:,.0f}៛ ({totals['KHR']['invoices']} invoices)"
+            f"🇺🇸 USD: {format_amount('USD', totals['USD']['total'])} ({totals['USD']['invoices']} invoices) | "
+            f"🇰🇭 KHR: {format_amount('KHR', totals['KHR']['total'])} ({totals['KHR']['invoices']} invoices)"
         )
         sent_msg = await update.message.reply_text("\n".join(response_lines), reply_markup=reply_menu(is_admin))
         context.application.create_task(auto_close_keyboard(context, chat_id, sent_msg.message_id))
@@ -531,13 +2550,7 @@ async def view_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.application.create_task(auto_close_keyboard(context, update.effective_chat.id, sent_msg.message_id))
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, chat_id, datetime, business_date, shift, currency, amount FROM history ORDER BY datetime DESC LIMIT 50"
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await run_in(DB_READERS, get_recent_history, 50)
 
     if not rows:
         sent_msg = await update.message.reply_text("📦 History empty.")
@@ -547,7 +2560,7 @@ async def view_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lines = []
     for r in rows:
         _id, c_id, dt, bdate, sh, cur, amt = r
-        lines.append(f"{dt} | biz:{bdate} | {sh} | {cur} {amt}")
+        lines.append(f"{dt} | biz:{bdate} | {sh} | {format_amount(cur, amt)}")
     text = "📂 Last 50 History:\n" + "\n".join(lines)
     # Telegram message limit ~4096 chars
     if len(text) > 4000:
@@ -556,52 +2569,204 @@ async def view_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.application.create_task(auto_close_keyboard(context, update.effective_chat.id, sent_msg.message_id))
 
 
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMINS:
+        await update.message.reply_text("🚫 Not allowed.")
+        return
+    lines = [
+        "🧮 Cache stats",
+        f"Totals: {TOTALS_CACHE.stats()}",
+        f"Old totals: {OLD_TOTALS_CACHE.stats()}",
+        f"Shift PDFs: {SHIFT_PDFS.stats()}",
+    ]
+    await update.message.reply_text("\n".join(lines))
+
+
+async def rate_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/rate shows the KHR per USD rate in force; /rate 4100 [YYYY-MM-DD] sets it from that business date on."""
+    user_id = update.effective_user.id
+    if user_id not in ADMINS:
+        await update.message.reply_text("🚫 Not allowed.")
+        return
+    args = context.args or []
+    _shift, biz_date_now = get_shift_and_business_date(chat_id=update.effective_chat.id)
+    date_str = next((a for a in args if DATE_ARG_RE.fullmatch(a)), biz_date_now)
+    values = [a for a in args if a != date_str]
+    if not values:
+        current = await run_in(DB_READERS, get_exchange_rate, date_str)
+        if current:
+            await update.message.reply_text(f"💱 1$ = {current[1]:,.0f}៛ on {date_str} (set from {current[0]}).")
+        else:
+            await update.message.reply_text(f"💱 No exchange rate set for {date_str}.")
+        return
+    try:
+        khr_per_usd = float(values[0].replace(",", ""))
+        # inf/nan would make every combined total after date_str fail
+        if len(values) > 1 or not math.isfinite(khr_per_usd) or khr_per_usd <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("⚠️ Usage: /rate [KHR per USD] [YYYY-MM-DD]")
+        return
+    await run_in(DB_WRITER, set_exchange_rate, khr_per_usd, date_str)
+    await update.message.reply_text(f"✅ 1$ = {khr_per_usd:,.0f}៛ from {date_str} on.")
+
+
+REZONE_USAGE = "Usage: /rezone <zone the rows were stamped in, e.g. UTC> [here|<chat_id>] <from> [to]"
+
+
+async def rezone_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMINS:
+        await update.message.reply_text("🚫 Not allowed.")
+        return
+    args = context.args or []
+    try:
+        if not args:
+            raise ValueError("Which zone were the rows recorded in?")
+        source_zone = args[0]
+        ZoneInfo(source_zone)
+        chat_id, date_from, date_to = parse_recalc_args(args[1:], update.effective_chat.id)
+        if not date_from:
+            raise ValueError("Give the date range to rezone.")
+    except (ValueError, KeyError) as e:  # ZoneInfoNotFoundError is a KeyError
+        await update.message.reply_text(f"⚠️ {e}\n{REZONE_USAGE}")
+        return
+    try:
+        changed = await run_in(DB_WRITER, rezone_history, source_zone, chat_id, date_from, date_to)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+        return
+    await update.message.reply_text(
+        f"✅ Re-derived {changed} history rows from {source_zone} to {BOT_TIMEZONE.key} and rebuilt their totals."
+    )
+
+
+SHIFTS_USAGE = "Usage: /shifts [HH:MM HH:MM HH:MM | default]"
+
+
+async def shifts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/shifts shows this chat's shift start times; /shifts 06:00 14:00 22:00 sets them, /shifts default resets them."""
+    user_id = update.effective_user.id
+    if user_id not in ADMINS:
+        await update.message.reply_text("🚫 Not allowed.")
+        return
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    if args:
+        try:
+            schedule = None if args == ["default"] else ShiftSchedule(args)
+        except ValueError as e:
+            await update.message.reply_text(f"⚠️ {e}\n{SHIFTS_USAGE}")
+            return
+        await run_in(DB_WRITER, set_shift_schedule, chat_id, schedule)
+    label = "own" if chat_id in CHAT_SHIFT_SCHEDULES else "default"
+    shift_now, biz_date_now = get_shift_and_business_date(chat_id=chat_id)
+    await update.message.reply_text(
+        f"🕐 Shift starts ({label}): {shift_schedule(chat_id).describe()}\nNow: {shift_now} of {biz_date_now}"
+    )
+
+
+def parse_recalc_args(args: list[str], current_chat_id: int):
+    """
+    /recalc arguments -> (chat_id, date_from, date_to).
+    "here" or a numeric id selects one chat; one date selects that day, two dates a range.
+    """
+    chat_id, dates = None, []
+    for arg in args:
+        if arg.lower() == "here":
+            chat_id = current_chat_id
+        elif DATE_ARG_RE.fullmatch(arg):
+            dates.append(arg)
+        elif re.fullmatch(r"-?\d+", arg):
+            chat_id = int(arg)
+        else:
+            raise ValueError(f"Unknown argument: {arg}")
+    if len(dates) > 2:
+        raise ValueError("At most two dates (from, to).")
+    date_from = dates[0] if dates else None
+    date_to = dates[-1] if dates else None
+    return chat_id, date_from, date_to
+
+
 async def recalc_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in ADMINS:
         await update.message.reply_text("🚫 Not allowed.")
         return
-    recalc_totals_from_history()
-    await update.message.reply_text("✅ Recalculated totals from history.")
+    try:
+        chat_id, date_from, date_to = parse_recalc_args(context.args or [], update.effective_chat.id)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}\nUsage: /recalc [here|<chat_id>] [YYYY-MM-DD] [YYYY-MM-DD]")
+        return
+
+    if chat_id is None and date_from is None:
+        await run_in(DB_WRITER, recalc_totals_from_history)
+        await update.message.reply_text("✅ Recalculated totals from history.")
+        return
+
+    await run_in(DB_WRITER, recalc_totals_scoped, chat_id, date_from, date_to)
+    scope = [f"chat {chat_id}" if chat_id is not None else "all chats"]
+    if date_from:
+        scope.append(date_from if date_from == date_to else f"{date_from} → {date_to or '…'}")
+    await update.message.reply_text(f"✅ Recalculated totals from history ({', '.join(scope)}).")
 
 
 # ==============================
 # ------------ Main ------------
 # ==============================
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("សួស្តី! Bot is ready ✅", reply_markup=reply_menu())
+
+
+def main():
     print("⚠️ Reminder:")
     print(" - totals.db will be created if missing")
     print(" - history table stores ALL data permanently (with business_date)")
-    print(" - Use /exportexcel or 📤 Export to download full Excel")
-    print(" - Use /recalc to rebuild totals from history")
+    print(" - Use /exportexcel [from] [to] [shift] [currency] or 📤 Export to download Excel")
+    print(" - Use /report [daily|weekly|monthly] [from] [to] [invoices] [pdf|xlsx] for PDF or Excel reports")
+    print(" - Use /recalc [here|<chat_id>] [from] [to] to rebuild totals from history")
+    print(" - Use /rate [KHR per USD] [from] to show or set the exchange rate for combined totals")
+    print(" - Use /shifts [HH:MM HH:MM HH:MM | default] to show or set this chat's shift start times")
+    print(" - Use /rezone <zone> [here|<chat_id>] <from> [to] to fix history recorded in the wrong time zone")
+    print(" - Shift totals move to Old Data automatically when each shift ends (AUTO_ROLLOVER=0 to turn off)")
     print("------------------------------------------------------")
 
-    init_db()
-    recalc_totals_from_history()  # ✅ Auto recalc before running bot
+    init_db()  # opens the pooled writer (WAL + pragmas) once for the process
+    recalc_totals_incremental()  # ✅ Fold in any history not yet in totals before running bot
+    if WRITE_QUEUE:
+        WRITE_QUEUE.start()
+        atexit.register(WRITE_QUEUE.close)  # last-chance flush if we exit without reaching finally
 
     if not BOT_TOKEN or len(BOT_TOKEN) < 20:
         raise RuntimeError("BOT_TOKEN missing. Set BOT_TOKEN env var or edit the code.")
-    
-    def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.run_polling()
-
-if __name__ == "__main__":
-    main()
-    
-    async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.message.reply_text("សួស្តី! Bot is ready ✅", reply_markup=reply_menu())
 
+    app = ApplicationBuilder().token(BOT_TOKEN).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("dump", view_db))
     app.add_handler(CommandHandler("recalc", recalc_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("rate", rate_cmd))
+    app.add_handler(CommandHandler("shifts", shifts_cmd))
+    app.add_handler(CommandHandler("rezone", rezone_cmd))
     app.add_handler(CommandHandler("exportexcel", export_excel_command))
+    app.add_handler(CommandHandler("export", export_excel_command))
+    app.add_handler(CommandHandler("report", report_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    if app.job_queue:
+        app.job_queue.run_repeating(shift_boundary_tick, interval=SHIFT_TICK_SECONDS, first=1, data={}, name="shift-boundary")
+    else:
+        print("⚠️ JobQueue unavailable (pip install 'python-telegram-bot[job-queue]'): no automatic rollover or pre-rendered shift PDFs")
 
     print("✅ Bot is running...")
-    app.run_polling(drop_pending_updates=True)
+    try:
+        app.run_polling(drop_pending_updates=True)
+    finally:
+        if WRITE_QUEUE:
+            WRITE_QUEUE.close()
+        shutdown_executors()
+        DB.close()
 
 
-    # Allows nested event loops (VS Code/Notebook)
-    import nest_asyncio
-    nest_asyncio.apply()
-    asyncio.run(main())
+if __name__ == "__main__":
+    main()